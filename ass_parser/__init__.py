@@ -1,7 +1,9 @@
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 import logging
 from re import compile
 import sys
+from time import perf_counter
+from misc.timings import timings
 
 
 class StyleInfo(object):
@@ -42,8 +44,39 @@ class UsageData(object):
         lines.sort()
         return 'Styles: %s, lines: %s' % (self.styles, lines)
 
+class EventCache(object):
+    """Bounded LRU cache of event processing results keyed by (style name, event text)"""
+
+    def __init__(self, max_size = 8192):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__items = OrderedDict()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def get(self, key):
+        try:
+            value = self.__items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.__items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def add(self, key, value):
+        self.__items[key] = value
+        if len(self.__items) > self.max_size:
+            self.__items.popitem(last=False)
+
+    def clear(self):
+        self.__items.clear()
+
 class AssParser(object):
     AssEvent = namedtuple('AssEvent', ['line_number', 'style', 'text', 'is_comment'] )
+    AssStyle = namedtuple('AssStyle', ['name', 'info'])
     AssBlockPlain = namedtuple('AssBlockPlain', ['text'])
 
     class AssBlockOverride(object):
@@ -52,16 +85,33 @@ class AssParser(object):
         tag_regex = compile(r'\\(i(?=[\d\\]|$)|b(?=[\d\\]|$)|fn|r|p(?=\d))((?<![ibp])[^\\]*|\d*)')
 
         def __init__(self, text):
-            self.tags = {f[0].lower():f[1] for f in self.tag_regex.findall(text)}
+            self.tags = AssParser.AssBlockOverride.parse(text)
+
+        @staticmethod
+        def parse(text):
+            return {f[0].lower():f[1] for f in AssParser.AssBlockOverride.tag_regex.findall(text)}
+
+        @staticmethod
+        def from_tags(tags):
+            block = AssParser.AssBlockOverride('')
+            block.tags = tags
+            return block
 
         def __repr__(self):
             return 'OverrideBlock(text=%s)' %  ''.join(('\\%s%s' %(name, value) for name, value in self.tags.items()))
 
         def get_tag(self, name, default):
-            value = self.tags[name]
-            if value is None or value == '':
-                return default
-            return value
+            return AssParser.get_tag(self.tags, name, default)
+
+    #either an override block with its contents or a run of plain text (or an unclosed override block)
+    token_regex = compile(r'\{([^}]*)\}|\{?[^{]*')
+
+    @staticmethod
+    def get_tag(tags, name, default):
+        value = tags[name]
+        if value is None or value == '':
+            return default
+        return value
 
 #    Style format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut,
 #                   ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
@@ -69,21 +119,48 @@ class AssParser(object):
 #    Event format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 
     @staticmethod
-    def get_fonts_statistics(path, exclude_unused_fonts = False, exclude_comments = False):
+    def get_fonts_statistics(path, exclude_unused_fonts = False, exclude_comments = False, event_cache = None):
+        if event_cache is None:
+            event_cache = EventCache()
+        used_styles = defaultdict(UsageData)
+        styles = {}
+        #events using styles (or \r to styles) defined further down the script
+        pending = []
+        #reading and processing are interleaved, so processing time is summed up per event
+        measure = timings.enabled
+        processing = 0.0
+        events = 0
+        start = perf_counter()
+
         try:
-            styles, events = AssParser.read_script(path)
+            for item in AssParser.iterate_script(path):
+                if isinstance(item, AssParser.AssStyle):
+                    styles[item.name] = item.info
+                    used_styles[item.info].styles.add(item.name)
+                    #cached results might refer to a redefined style
+                    event_cache.clear()
+                    continue
+                if exclude_comments and item.is_comment:
+                    continue
+                events += 1
+                event_start = perf_counter() if measure else 0.0
+                try:
+                    AssParser.process_event(item, used_styles, styles, event_cache)
+                except KeyError:
+                    pending.append(item)
+                if measure:
+                    processing += perf_counter() - event_start
+
+            event_start = perf_counter()
+            for event in pending:
+                AssParser.process_event(event, used_styles, styles)
+            processing += perf_counter() - event_start
         except Exception as e:
             logging.critical('Failed to parse script %s: %s' % (path, e))
             sys.exit(1)
-        used_styles = defaultdict(UsageData)
-
-        for name, info in styles.items():
-            used_styles[info].styles.add(name)
-
-        for event in events:
-            if exclude_comments and event.is_comment:
-                continue
-            AssParser.process_event(event, used_styles, styles)
+        timings.add('script read', perf_counter() - start - processing)
+        timings.add('event processing', processing, events)
+        logging.debug('Event cache: %i hits, %i misses' % (event_cache.hits, event_cache.misses))
 
         if exclude_unused_fonts:
             for info, usage in  list(used_styles.items()):
@@ -94,38 +171,82 @@ class AssParser(object):
 
 
     @staticmethod
-    def process_event(event, used_styles, styles):
-        blocks = AssParser.parse_tags(event.text)
-        style = styles[event.style].clone()
+    def process_event(event, used_styles, styles, cache = None):
+        key = (event.style, event.text)
+        usage = cache.get(key) if cache is not None else None
+        if usage is None:
+            usage = AssParser.get_event_usage(event.style, event.text, styles)
+            if cache is not None:
+                cache.add(key, usage)
+
+        for style, (chars, overriden) in usage.items():
+            used_style = used_styles[style]
+            if overriden:
+                used_style.lines.add(event.line_number)
+            used_style.chars.update(chars)
+
+
+    @staticmethod
+    def get_event_usage(style_name, text, styles):
+        """Returns dict StyleInfo -> (chars, overriden) for a single event"""
+        usage = {}
+        style = styles[style_name].clone()
         initial = style.clone()
         overriden = False
-        for block in blocks:
-            try:
-                #if isinstance(block, AssParser.AssBlockOverride):
-                if 'r' in block.tags:
-                    style = styles[block.get_tag('r', event.style)].clone()
+        for tags, text in AssParser.tokenize(text):
+            if tags is not None:
+                if 'r' in tags:
+                    style = styles[AssParser.get_tag(tags, 'r', style_name)].clone()
                     overriden = False
-                if 'b' in block.tags:
-                    value = block.get_tag('b', initial.bold)
+                if 'b' in tags:
+                    value = AssParser.get_tag(tags, 'b', initial.bold)
                     bold = 0 if value == '0' else 1 if value == '1' else int(value)
                     style = StyleInfo(style.fontname, bold, style.italic)
                     overriden = True
-                if 'i' in block.tags:
-                    style = StyleInfo(style.fontname, style.bold, bool(int(block.get_tag('i', initial.italic))))
+                if 'i' in tags:
+                    style = StyleInfo(style.fontname, style.bold, bool(int(AssParser.get_tag(tags, 'i', initial.italic))))
                     overriden = True
-                if 'fn' in block.tags:
-                    style = StyleInfo(block.get_tag('fn', initial.fontname), style.bold, style.italic)
+                if 'fn' in tags:
+                    style = StyleInfo(AssParser.get_tag(tags, 'fn', initial.fontname), style.bold, style.italic)
                     overriden = True
-            except AttributeError: #AssParser.AssBlockPlain
-                if not block.text:
-                    continue
+                continue
 
-                used_style = used_styles[style]
-                if overriden:
-                    used_style.lines.add(event.line_number)
+            str = text.replace(r'\n','').replace(r'\N','').replace(r'\h', "\xA0")
+            try:
+                chars, was_overriden = usage[style]
+                chars.update(str)
+                usage[style] = (chars, was_overriden or overriden)
+            except KeyError:
+                usage[style] = (set(str), overriden)
+        return usage
 
-                str = block.text.replace(r'\n','').replace(r'\N','').replace(r'\h', "\xA0")
-                used_style.chars.update(str)
+
+    @staticmethod
+    def tokenize(text):
+        """Yields (tags, None) for override blocks and (None, text) for non-empty text runs outside of drawings"""
+        drawing = False
+        for match in AssParser.token_regex.finditer(text):
+            override = match.group(1)
+            if override is not None:
+                if not '\\' in override:
+                    #comment line - do nothing
+                    continue
+                tags = AssParser.AssBlockOverride.parse(override)
+                if not tags:
+                    continue
+                if 'p' in tags:
+                    drawing = tags['p'] != '0'
+                yield tags, None
+                continue
+
+            start, end = match.span()
+            if start == end:
+                continue
+            if text[start] == '{':
+                logging.warning('Broken line: %s' % text)
+            if not drawing:
+                #drawing commands are skipped without being sliced out of the line
+                yield None, text[start:end]
 
 
     @staticmethod
@@ -134,81 +255,43 @@ class AssParser(object):
             return []
 
         blocks = []
-        drawing = False
-        cur = 0
-        strlen = len(text)
-        #todo: this whole thing is way too C++
-        while cur < strlen:
-            if text[cur] == '{':
-                end = text.find('}', cur)
-                if end == -1:
-                    logging.warning('Broken line: %s' % text)
-                    cur = AssParser.process_plain_text(blocks, text, cur, drawing)
-                else:
-                    cur, drawing = AssParser.process_override_block(blocks, text, cur, end, drawing)
+        for tags, plain in AssParser.tokenize(text):
+            if tags is not None:
+                blocks.append(AssParser.AssBlockOverride.from_tags(tags))
             else:
-                cur = AssParser.process_plain_text(blocks, text, cur, drawing)
-
+                blocks.append(AssParser.AssBlockPlain(plain))
         return blocks
 
-
     @staticmethod
-    def process_override_block(blocks, text, pos, end, drawing):
-        work = text[pos+1:end]
-        if not '\\' in work:
-            #comment line - do nothing
-            pass
-        else:
-            block = AssParser.AssBlockOverride(work)
-            if not block.tags:
-                return end+1, drawing
-            blocks.append(block)
-            try:
-                drawing = block.tags['p'] != '0'
-            except KeyError:
-                pass
-        return end+1, drawing
-
-    @staticmethod
-    def process_plain_text(blocks, text, pos, drawing):
-        end = text.find('{', pos+1)
-        if end == -1:
-            work = text[pos:]
-            pos = len(text)
-        else:
-            work = text[pos:end]
-            pos = end
-        if drawing:
-            pass
-        else:
-            blocks.append(AssParser.AssBlockPlain(work))
-        return pos
+    def read_script(path):
+        styles = {}
+        events = []
+        for item in AssParser.iterate_script(path):
+            if isinstance(item, AssParser.AssStyle):
+                styles[item.name] = item.info
+            else:
+                events.append(item)
+        return styles, events
 
     @staticmethod
-    def read_script(path):
+    def iterate_script(path):
+        """Yields AssStyle and AssEvent items one by one. Only style and event lines are decoded"""
         try:
-            with open(path, encoding='utf-8') as file:
-                script = file.read()
+            file = open(path, 'rb')
         except IOError:
             logging.critical("Script at path %s wasn't found" % path)
             sys.exit(2)
-        styles = {}
-        events = []
         idx = 1
-        for line in script.splitlines():
-            try:
-                descriptor, value = line.split(':', 1)
-            except ValueError:
-                continue
-            if descriptor not in {'Dialogue', 'Comment', 'Style'}:
-                continue
-            if descriptor in {'Dialogue', 'Comment'}:
-                event = value.split(',', 9) #len(EventFormat) - 1
-                ass_event = AssParser.AssEvent(idx, event[3], event[9].strip(), True if descriptor=='Comment' else False)
-                idx += 1
-                events.append(ass_event)
-            else:
-                ass_style = value.split(',', 22) #len(AssParser.EventFormat) - 1
-                style_info = StyleInfo.from_ass(ass_style[1], ass_style[7], ass_style[8])#
-                styles[ass_style[0].strip()] = style_info
-        return styles, events
+        with file:
+            for line in file:
+                if not line.startswith((b'Dialogue:', b'Comment:', b'Style:')):
+                    continue
+                descriptor, value = line.decode('utf-8').split(':', 1)
+                if descriptor in {'Dialogue', 'Comment'}:
+                    event = value.split(',', 9) #len(EventFormat) - 1
+                    yield AssParser.AssEvent(idx, event[3], event[9].strip(), True if descriptor=='Comment' else False)
+                    idx += 1
+                else:
+                    ass_style = value.split(',', 22) #len(AssParser.EventFormat) - 1
+                    style_info = StyleInfo.from_ass(ass_style[1], ass_style[7], ass_style[8])
+                    yield AssParser.AssStyle(ass_style[0].strip(), style_info)
@@ -4,20 +4,27 @@ import argparse
 import logging
 from time import ctime, time
 import sys
-from ass_parser import AssParser
-from font_loader import FontLoader
+from misc.timings import timings
 import os
+import json
 from json import JSONDecoder
-from subprocess import call
-import cProfile
-from shutil import copy2 as copyfile
+
+#font and script subsystems and heavy standard modules are imported by the functions needing them,
+#so modes like forwarding lookups to a font server don't pay for them on startup
 
 default_config = { "font_dirs":[],
             "include_system_fonts":True,
             "verbose":False,
             "exclude_unused_fonts":False,
             "exclude_comments":False,
-            "log_file":None}
+            "log_file":None,
+            "workers":1,
+            "use_daemon":True,
+            "watch_interval":5,
+            "daemon_socket":None,
+            "copy_mode":"clone",
+            "use_mkvmerge":False,
+            "shared_cache":None}
 
 def get_script_directory():
     return os.path.dirname(__file__)
@@ -28,7 +35,8 @@ def merge_configs(args, file, default):
     config.update(args.__dict__)
 
     for key, value in config.items():
-        if key not in {'output_location', 'additional_font_dirs'} and value is None:
+        if key not in {'output_location', 'additional_font_dirs', 'daemon_socket', 'timings_json', 'profile',
+                       'shared_cache', 'build_shared_cache'} and value is None:
             config[key] = file[key] if key in file and file[key] is not None else default[key]
     if config['additional_font_dirs']:
         config['font_dirs'].extend(config['additional_font_dirs'])
@@ -52,46 +60,105 @@ def set_logging(log_file, verbose):
         logging.getLogger('').addHandler(console)
 
 def create_mmg_command(mmg_path, output_path, script_path, fonts):
-    font_list = ('--attachment-mime-type application/x-truetype-font --attachment-name "{0}" --attach-file "{1}"'.format(os.path.basename(font.path), font.path) for font in fonts)
-    attachment_string = ' '.join(font_list)
-    return '{0} -o "{1}" "{2}" {3}'.format(os.path.abspath(mmg_path), os.path.abspath(output_path), os.path.abspath(script_path), attachment_string)
+    command = [os.path.abspath(mmg_path), '-o', os.path.abspath(output_path), os.path.abspath(script_path)]
+    for font in fonts:
+        command += ['--attachment-mime-type', 'application/x-truetype-font', '--attachment-name', os.path.basename(font.path),
+                    '--attach-file', font.path]
+    return command
 
-def create_mks_file(mmg_path, output_path, script_path, fonts):
-    command = create_mmg_command(mmg_path, output_path, script_path, fonts)
-    logging.debug('mks creation command: %s' % command)
-    call(command)
+def create_mks_file(config, output_path, script_path, fonts):
+    fonts = list(fonts)
+    if config['use_mkvmerge']:
+        command = create_mmg_command(config['mmg'], output_path, script_path, fonts)
+        logging.debug('mks creation command: %s' % command)
+        from subprocess import call
+        call(command)
+        return
+    from misc.matroska import write_mks_file
+    logging.debug('Writing %s with %i attachments' % (output_path, len(fonts)))
+    write_mks_file(output_path, script_path, [font.path for font in fonts])
 
-def copy_fonts_to_folder(folder, fonts):
+def prepare_output_folder(folder):
     folder = os.path.abspath(folder)
-    logging.info('Copying fonts to %s' % folder)
     if not os.path.exists(folder):
-        os.mkdir(folder)
+        os.makedirs(folder)
     if not os.path.isdir(folder):
         logging.critical('File with the same name already exists at %s' % folder)
         sys.exit(1)
-    for font in fonts:
-        filename = os.path.basename(font.path)
-        dest = os.path.join(folder, filename)
-        copyfile(font.path, dest)
+    return folder
 
-def process(args):
-    config = get_config(args)
-    set_logging(config['log_file'], config['verbose'])
+def copy_fonts_to_folder(folder, fonts, mode = 'clone'):
+    from misc.file_copy import copy_files
+    folder = prepare_output_folder(folder)
+    logging.info('Copying fonts to %s' % folder)
+    results = copy_files([(font.path, os.path.join(folder, os.path.basename(font.path))) for font in fonts], mode)
+    logging.debug('Fonts copied: %i, cloned: %i, linked: %i, already up to date: %i' %
+                  (results['copied'], results['cloned'], results['linked'], results['skipped']))
 
-    logging.debug(str(config))
+def get_font_chars(resolved, fonts, font_chars=None):
+    """Merges characters of all styles using the same font. resolved has to hold every style resolved to a font,
+    not only the ones in found. TTC members share a path, so fonts are told apart by names too"""
+    font_chars = {} if font_chars is None else font_chars
+    for style, font in resolved.items():
+        key = (font.path, tuple(sorted(font.names)), font.bold, font.italic)
+        font_chars.setdefault(key, (font, set()))[1].update(fonts[style].chars)
+    return font_chars
 
-    start_time = time()
-    logging.info('-----Started new task at %s-----' % str(ctime()))
+def subset_fonts_to_folder(folder, font_chars):
+    """Writes fonts reduced to the glyphs of used characters. Returns FontInfo of the written files"""
+    from shutil import copy2 as copyfile
+    from font_loader.font_info import FontInfo
+    from font_loader.subsetter import write_subset_font
+    folder = prepare_output_folder(folder)
+    logging.info('Writing subsetted fonts to %s' % folder)
+    written = []
+    for font, chars in font_chars.values():
+        try:
+            path = write_subset_font(font, chars, folder)
+        except Exception as e:
+            logging.error("Couldn't subset font %s, copying it whole: %s" % (font.path, e))
+            path = os.path.join(folder, os.path.basename(font.path))
+            copyfile(font.path, path)
+        logging.debug('Subsetted %s to %i characters: %i -> %i bytes' % (font.path, len(chars), os.path.getsize(font.path), os.path.getsize(path)))
+        written.append(FontInfo(font.names, font.bold, font.italic, font.weight, path, None))
+    return written
 
-    fonts =  AssParser.get_fonts_statistics(os.path.abspath(config['script']), config['exclude_unused_fonts'], config['exclude_comments'])
+def expand_script_paths(paths):
+    from glob import glob
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            scripts.extend(sorted(glob(os.path.join(path, '*.ass'))))
+        elif any(char in path for char in '*?['):
+            scripts.extend(sorted(glob(path)))
+        else:
+            scripts.append(path)
+    return [os.path.abspath(x) for x in scripts]
 
-    if config['rebuild_cache']:
-        FontLoader.discard_cache()
+def collect_script_statistics(path, exclude_unused_fonts, exclude_comments):
+    #AssParser exits on broken scripts, in batch mode we only skip them
+    from ass_parser import AssParser
+    try:
+        return AssParser.get_fonts_statistics(path, exclude_unused_fonts, exclude_comments)
+    except SystemExit:
+        return None
+    except Exception as e:
+        logging.error("Couldn't read script %s: %s: %s" % (path, type(e).__name__, e))
+        return None
 
-    collector = FontLoader(config['font_dirs'], config['include_system_fonts'])
+def get_scripts_statistics(scripts, exclude_unused_fonts, exclude_comments, workers):
+    if not workers:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(scripts))
+    if workers < 2:
+        return [collect_script_statistics(x, exclude_unused_fonts, exclude_comments) for x in scripts]
 
-    found, not_found = collector.get_fonts_for_list(fonts)
+    #fonts are loaded on another thread meanwhile
+    from misc import create_process_pool
+    with create_process_pool(workers) as executor:
+        return list(executor.map(collect_script_statistics, scripts, [exclude_unused_fonts] * len(scripts), [exclude_comments] * len(scripts)))
 
+def report_not_found(not_found):
     for font, usage in not_found.items():
         text = "Could not find font '%s'" % str(font)
         if usage.styles:
@@ -104,16 +171,281 @@ def process(args):
         text += '\n\n'
         logging.warning(text)
 
-    logging.info('Total found: %i', len(found))
-    logging.info('Total not found: %i', len(not_found))
+def report_missing_glyphs(missing_glyphs):
+    for font, chars in missing_glyphs.items():
+        text = ''.join(sorted(chars))
+        if len(text) > 50:
+            text = text[:50] + '...'
+        logging.warning("Font found for '%s' has no glyphs for %i characters used with it: %s" % (str(font), len(chars), text))
+
+def get_script_output_location(output_location, script, mks):
+    if not os.path.isdir(output_location):
+        os.makedirs(output_location)
+    name = os.path.splitext(os.path.basename(script))[0]
+    return os.path.join(output_location, name + '.mks' if mks else name)
 
-    if config['output_location'] is not None:
-        if config['output_location'].endswith('.mks'):
-            create_mks_file(config['mmg'], config['output_location'], config['script'], found.values())
+def write_output(config, output_location, script, fonts, font_chars=None):
+    """Copies or muxes fonts, or their subsets when font_chars are given"""
+    with timings.stage('output', len(fonts)):
+        write_fonts(config, output_location, script, fonts, font_chars)
+
+def write_fonts(config, output_location, script, fonts, font_chars):
+    if output_location.endswith('.mks'):
+        if font_chars is None:
+            create_mks_file(config, output_location, script, fonts)
         else:
-            copy_fonts_to_folder(config['output_location'], found.values())
+            from tempfile import TemporaryDirectory
+            with TemporaryDirectory() as folder:
+                create_mks_file(config, output_location, script, subset_fonts_to_folder(folder, font_chars))
+    elif font_chars is None:
+        copy_fonts_to_folder(output_location, fonts, config['copy_mode'])
+    else:
+        subset_fonts_to_folder(output_location, font_chars)
+
+def is_daemon_supported():
+    import socket
+    return hasattr(socket, 'AF_UNIX')
+
+def get_daemon_socket_path(config):
+    from font_server import get_default_socket_path
+    return config['daemon_socket'] or get_default_socket_path()
+
+def connect_to_daemon(config):
+    if not config['use_daemon'] or config['rebuild_cache'] or not is_daemon_supported():
+        return None
+    socket_path = get_daemon_socket_path(config)
+    if not os.path.exists(socket_path):
+        return None
+    from font_server import FontClient
+    client = FontClient(socket_path, config['font_dirs'], config['include_system_fonts'])
+    if not client.is_compatible():
+        logging.debug('Font server at %s is not running or uses different font directories' % socket_path)
+        return None
+    logging.debug('Forwarding font lookups to font server at %s' % socket_path)
+    return client
+
+def create_loader(config):
+    from font_loader import FontLoader
+    return FontLoader(config['font_dirs'], config['include_system_fonts'], config['workers'], config['shared_cache'])
+
+def build_shared_cache(config):
+    """Brings a cache other users can layer their own cache on up to date. It covers the configured font directories"""
+    from font_loader import FontLoader
+    path = os.path.abspath(config['build_shared_cache'])
+    logging.info('Updating shared font cache %s' % path)
+    FontLoader(config['font_dirs'], config['include_system_fonts'], config['workers'], cache_path=path)
+    logging.info('Done. Point shared_cache in config.json of other users to it')
+
+def run_daemon(config):
+    if not is_daemon_supported():
+        logging.critical('Font server requires Unix domain sockets')
+        sys.exit(2)
+    from font_loader import FontLoader
+    from font_server import FontServer
+    if config['rebuild_cache']:
+        FontLoader.discard_cache()
+    loader = create_loader(config)
+    server = FontServer(get_daemon_socket_path(config), loader, config['font_dirs'], config['include_system_fonts'])
+    watcher = None
+    if config['watch']:
+        from font_loader.watcher import FontWatcher
+        watcher = FontWatcher(loader, config['watch_interval'])
+        watcher.start()
+    logging.info('Font server is listening on %s' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if watcher:
+            watcher.stop()
+
+def run_watcher(config):
+    from font_loader import FontLoader
+    from font_loader.watcher import FontWatcher
+    if config['rebuild_cache']:
+        FontLoader.discard_cache()
+    loader = create_loader(config)
+    logging.info('Watching font directories for changes')
+    try:
+        FontWatcher(loader, config['watch_interval']).run()
+    except KeyboardInterrupt:
+        pass
+
+def run_timed(function, *args):
+    start = time()
+    result = function(*args)
+    return result, time() - start
+
+#profilers of threads other than the main one, cProfile only records the thread it was enabled on
+thread_profilers = []
+
+def run_profiled(function, *args):
+    import cProfile
+    profiler = cProfile.Profile()
+    thread_profilers.append(profiler)
+    return profiler.runcall(function, *args)
+
+def load_collector(config):
+    """Returns a client of a compatible font server if one is running, otherwise a loaded FontLoader"""
+    with timings.stage('font loading'):
+        collector = connect_to_daemon(config)
+        if collector is None:
+            from font_loader import FontLoader
+            if config['rebuild_cache']:
+                FontLoader.discard_cache()
+            collector = create_loader(config)
+    return collector
+
+def report_overlap(scripts_time, loading_time, elapsed):
+    overlap = max(0.0, scripts_time + loading_time - elapsed)
+    timings.add('overlap', overlap)
+    logging.debug('Script analysis took %.3fs, font loading %.3fs, %.3fs of it overlapped (%.0f%% of the shorter one)' %
+                  (scripts_time, loading_time, overlap, overlap * 100 / (min(scripts_time, loading_time) or 1)))
+
+def process(args):
+    with timings.stage('config'):
+        config = get_config(args)
+    set_logging(config['log_file'], config['verbose'])
+
+    logging.debug(str(config))
+
+    if config['daemon']:
+        run_daemon(config)
+        return
+    if config['watch']:
+        run_watcher(config)
+        return
+    if config['build_shared_cache']:
+        build_shared_cache(config)
+        return
+
+    start_time = time()
+    logging.info('-----Started new task at %s-----' % str(ctime()))
+
+    scripts = expand_script_paths(config['scripts'] or [])
+    if not scripts:
+        logging.critical('No scripts found')
+        sys.exit(2)
+    batch = len(scripts) > 1
+    output_location = config['output_location']
+    if batch and output_location is not None and output_location.endswith('.mks') and not config['per_script']:
+        logging.critical('Several scripts can only be muxed to mks files with --per-script')
+        sys.exit(2)
+
+    #scripts and fonts don't depend on each other until matching, so fonts are loaded while scripts are parsed
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(1) as executor:
+        start = time()
+        if args.profile:
+            loading = executor.submit(run_timed, run_profiled, load_collector, config)
+        else:
+            loading = executor.submit(run_timed, load_collector, config)
+        with timings.stage('scripts', len(scripts)):
+            statistics = get_scripts_statistics(scripts, config['exclude_unused_fonts'], config['exclude_comments'], config['workers'])
+        scripts_time = time() - start
+        collector, loading_time = loading.result()
+    report_overlap(scripts_time, loading_time, time() - start)
+
+    all_found = {}
+    all_font_chars = {}
+    all_not_found = set()
+    failed = 0
+    for script, fonts in zip(scripts, statistics):
+        if fonts is None:
+            failed += 1
+            continue
+        if batch:
+            logging.info('-----Script %s-----' % script)
+
+        found, not_found = collector.get_fonts_for_list(fonts)
+        report_not_found(not_found)
+        report_missing_glyphs(collector.missing_glyphs)
+
+        logging.info('Total found: %i', len(found))
+        logging.info('Total not found: %i', len(not_found))
+
+        for font in found.values():
+            all_found[font.path] = font
+        all_not_found.update(not_found.keys())
+        font_chars = None
+        if config['subset']:
+            font_chars = get_font_chars(collector.resolved, fonts)
+            get_font_chars(collector.resolved, fonts, all_font_chars)
+
+        if output_location is not None:
+            if not batch:
+                write_output(config, output_location, script, found.values(), font_chars)
+            elif config['per_script']:
+                write_output(config, get_script_output_location(output_location, script, config['mks']), script, found.values(), font_chars)
+
+    if batch:
+        logging.info('-----All scripts-----')
+        logging.info('Scripts processed: %i, failed: %i', len(scripts) - failed, failed)
+        logging.info('Total found: %i', len(all_found))
+        logging.info('Total not found: %i', len(all_not_found))
+        if output_location is not None and not config['per_script']:
+            with timings.stage('output', len(all_found)):
+                if config['subset']:
+                    subset_fonts_to_folder(output_location, all_font_chars)
+                else:
+                    copy_fonts_to_folder(output_location, all_found.values(), config['copy_mode'])
 
     logging.debug('Job done in %fs' % round(time() - start_time, 5))
+    if failed:
+        sys.exit(1)
+
+def write_instrumentation_report(args, profiler):
+    report = {}
+    if profiler is not None:
+        profiler.disable()
+
+    if args.trace_memory:
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        tracemalloc.stop()
+        logging.info('Memory: %.1f KiB allocated, %.1f KiB peak. Largest allocations:\n%s' %
+                     (current / 1024, peak / 1024, '\n'.join('  %s' % x for x in top)))
+        report['memory'] = {'current': current, 'peak': peak,
+                            'top': [{'location': str(x.traceback), 'size': x.size, 'count': x.count} for x in top]}
+
+    if profiler is not None:
+        import io
+        import pstats
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        for thread_profiler in thread_profilers:
+            stats.add(thread_profiler)
+        stats.dump_stats(args.profile)
+        stats.sort_stats('cumulative').print_stats(20)
+        logging.info('Profile written to %s\n%s' % (args.profile, stream.getvalue()))
+
+    if timings.enabled:
+        timings.report()
+        if args.timings_json:
+            report.update(timings.to_json())
+            with open(args.timings_json, 'w') as file:
+                json.dump(report, file, indent=2)
+
+def run(args):
+    """Runs process with the timings, profiling and memory tracing asked for on the command line"""
+    timings.enabled = bool(args.timings or args.timings_json)
+    profiler = None
+    if args.trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time()
+    try:
+        process(args)
+    finally:
+        timings.add('total', time() - start)
+        write_instrumentation_report(args, profiler)
 
 
 if __name__ == '__main__':
@@ -136,12 +468,34 @@ if __name__ == '__main__':
     parser.add_argument('-v','--verbose', action='store_true', dest='verbose', help='print additional log info (debug level)')
     parser.add_argument('--log', dest='log_file', metavar='file', help='Output log to file')
     parser.add_argument('--rebuild-cache', action='store_true', dest='rebuild_cache', help='Rebuild font cache')
+    parser.add_argument('-j', '--workers', type=int, dest='workers', metavar='count', help='Number of processes used to scan new fonts (0 for one per CPU)')
 
     parser.add_argument('-o', '--output', default=None, dest='output_location', metavar='folder/file', help='output folder or mks file')
-    parser.add_argument('script', default=None, help='input script')
+    parser.add_argument('--per-script', action='store_true', dest='per_script', help='with several scripts, write output of every script separately into the output folder')
+    parser.add_argument('--mks', action='store_true', dest='mks', help='with --per-script, create an mks file for every script instead of a font folder')
+    parser.add_argument('--copy-mode', choices=['clone', 'copy', 'hardlink'], dest='copy_mode',
+                        help='How fonts are put into the output folder: clone shares blocks on copy-on-write file systems, '
+                             'hardlink links them (edits then affect the originals). Both fall back to copying. '
+                             'Files already up to date are skipped in any mode')
+    parser.add_argument('--subset', action='store_true', dest='subset', help='Attach fonts reduced to the glyphs of characters used in the script')
+    parser.add_argument('--mkvmerge', action='store_true', dest='use_mkvmerge', help='Create mks files with mkvmerge (path set in config) instead of the built-in writer')
+    parser.add_argument('--shared-cache', dest='shared_cache', metavar='file', help='Read-only font cache built with --build-shared-cache, your own cache only records differences to it')
+    parser.add_argument('--build-shared-cache', dest='build_shared_cache', metavar='file', help='Create or update a shared font cache for the configured font directories and exit')
+    parser.add_argument('--daemon', action='store_true', dest='daemon', help='Keep fonts loaded and serve lookups of other runs over a Unix socket')
+    parser.add_argument('--socket', dest='daemon_socket', metavar='path', help='Socket of the font server')
+    parser.add_argument('--watch', action='store_true', dest='watch', help='Keep the font cache up to date while font directories change (in the background with --daemon)')
+    parser.add_argument('--no-daemon', action='store_false', dest='use_daemon', help="Don't forward lookups to a running font server")
+    parser.add_argument('--timings', action='store_true', dest='timings', help='Report time spent in every stage and the slowest font files')
+    parser.add_argument('--timings-json', dest='timings_json', metavar='file', help='Write timings (and memory statistics) as JSON, implies --timings')
+    parser.add_argument('--profile', dest='profile', metavar='file', help='Run under cProfile and write the statistics to file')
+    parser.add_argument('--trace-memory', action='store_true', dest='trace_memory', help='Report the largest memory allocations')
+    parser.add_argument('scripts', nargs='*', metavar='script', help='input scripts, directories with scripts or wildcards')
     parser.set_defaults(include_system_fonts = None, exclude_comments=None, exclude_unused_fonts = None,
-                        verbose = None, log_file = None, rebuild_cache=False, output_location=None)
+                        verbose = None, log_file = None, rebuild_cache=False, output_location=None, workers=None,
+                        per_script=False, mks=False, daemon=False, use_daemon=None, daemon_socket=None,
+                        watch=False, subset=False, timings=False, timings_json=None, profile=None, trace_memory=False,
+                        copy_mode=None, use_mkvmerge=None,
+                        shared_cache=None, build_shared_cache=None)
     args = parser.parse_args(sys.argv[1:])
-    process(args)
-#    cProfile.run('process(args)', sort='time', filename='profile.txt')
+    run(args)
 
@@ -0,0 +1,180 @@
+from collections import OrderedDict
+import os
+import random
+import statistics
+import struct
+import subprocess
+import sys
+from time import perf_counter
+from ass_parser import AssParser
+from font_loader import FontLoader, TTFFont
+from font_loader.subsetter import read_table_directory, build_font
+
+#fonts of the test suite the synthetic corpus is made of
+source_fonts = ['Jorvik.ttf', 'seriously.ttf', 'VANTATHI.TTF', 'Caviar Dreams Bold.ttf', 'CaviarDreams_Italic.ttf',
+                'YanoneKaffeesatz-Regular.otf', 'YanoneKaffeesatz-Bold.otf', 'otfpoc.otf']
+
+words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'привет', 'мир', 'こんにちは']
+
+script_header = '''[Script Info]
+ScriptType: v4.00+
+PlayResX: 1280
+PlayResY: 720
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+'''
+
+style_line = 'Style: %s,%s,40,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,%i,%i,0,0,100,100,0,0,1,2,2,2,10,10,10,1\n'
+event_line = 'Dialogue: 0,0:%02i:%02i.00,0:%02i:%02i.00,%s,,0,0,0,,%s\n'
+
+
+def get_source_font_path(name):
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'files', name)
+
+
+def build_name_table(names):
+    """names is dict name id -> string. Writes windows unicode records only"""
+    strings = [(name_id, value.encode('utf-16be')) for name_id, value in sorted(names.items())]
+    data = struct.pack('>HHH', 0, len(strings), 6 + len(strings) * 12)
+    offset = 0
+    for name_id, value in strings:
+        data += struct.pack('>6H', 3, 1, 0x409, name_id, len(value), offset)
+        offset += len(value)
+    return data + b''.join(x[1] for x in strings)
+
+
+def make_renamed_font(path, family):
+    """Returns font file data of path with its family renamed, so copies are distinct fonts rather than duplicates"""
+    headers = TTFFont(path, fast_scan=False).headers
+    subfamily = (headers[TTFFont.TTFNameId.FontSubFamilyName] or ['Regular'])[0]
+    with open(path, 'rb') as file:
+        data = file.read()
+    version, directory = read_table_directory(data, 0)
+    tables = {tag: data[offset:offset + length] for tag, (offset, length) in directory.items()}
+    tables[b'name'] = build_name_table({TTFFont.TTFNameId.FontFamilyName: family,
+                                        TTFFont.TTFNameId.FontSubFamilyName: subfamily,
+                                        TTFFont.TTFNameId.FullFontName: '%s %s' % (family, subfamily)})
+    return bytes(build_font(version, tables))
+
+
+def make_collection(fonts):
+    """Joins standalone font files into a TTC. Members keep their own tables, only table offsets are moved"""
+    header = struct.pack('>4sIL', b'ttcf', 0x00010000, len(fonts))
+    offset = len(header) + len(fonts) * 4
+    offsets = []
+    members = bytearray()
+    for font in fonts:
+        member = bytearray(font + b'\0' * (-len(font) % 4))
+        base = offset + len(members)
+        for index in range(struct.unpack_from('>H', member, 4)[0]):
+            pos = 12 + index * 16 + 8
+            struct.pack_into('>L', member, pos, struct.unpack_from('>L', member, pos)[0] + base)
+        offsets.append(base)
+        members += member
+    return header + struct.pack('>%iL' % len(offsets), *offsets) + members
+
+
+def generate_font_directory(directory, count, collection_share=0.2, seed=0):
+    """Writes count renamed copies of the test fonts, some of them joined into TTCs. Returns list of family names"""
+    rng = random.Random(seed)
+    families = []
+    pending = []
+    for index in range(count):
+        source = source_fonts[index % len(source_fonts)]
+        family = 'Bench %s %i' % (os.path.splitext(source)[0], index)
+        families.append(family)
+        data = make_renamed_font(get_source_font_path(source), family)
+        folder = os.path.join(directory, 'dir%i' % (index % 10))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        if source.lower().endswith('.ttf') and rng.random() < collection_share:
+            pending.append(data)
+            if len(pending) == 2:
+                with open(os.path.join(folder, 'collection%i.ttc' % index), 'wb') as file:
+                    file.write(make_collection(pending))
+                pending = []
+            continue
+        with open(os.path.join(folder, 'font%i%s' % (index, os.path.splitext(source)[1])), 'wb') as file:
+            file.write(data)
+    if pending:
+        with open(os.path.join(directory, 'last.ttf'), 'wb') as file:
+            file.write(pending[0])
+    return families
+
+
+def generate_event_text(rng, families, override_density, karaoke, drawing):
+    if drawing and rng.random() < drawing:
+        return '{\\an7\\pos(100,100)\\p1}m 0 0 l 100 0 100 100 0 100{\\p0}'
+    parts = []
+    for index in range(rng.randint(3, 12)):
+        if karaoke and rng.random() < karaoke:
+            parts.append('{\\k%i}' % rng.randint(5, 50))
+        if rng.random() < override_density:
+            tag = rng.choice(['\\b1', '\\i1', '\\b0', '\\i0', '\\fn' + rng.choice(families), '\\r', '\\c&H00FF00&', '\\fs30'])
+            parts.append('{%s}' % tag)
+        parts.append(rng.choice(words) + ' ')
+    return ''.join(parts)
+
+
+def generate_script(path, families, events, styles=10, override_density=0.2, karaoke=0.0, drawing=0.0, seed=0):
+    """Writes an ASS script with events using fonts of families"""
+    rng = random.Random(seed)
+    style_names = ['Style%i' % x for x in range(styles)]
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(script_header)
+        for name in style_names:
+            file.write(style_line % (name, rng.choice(families), rng.choice([0, -1]), rng.choice([0, -1])))
+        file.write('\n[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n')
+        for index in range(events):
+            start = index % 3600
+            file.write(event_line % (start // 60, start % 60, (start + 2) // 60, (start + 2) % 60, rng.choice(style_names),
+                                     generate_event_text(rng, families, override_density, karaoke, drawing)))
+
+
+def measure(function, repeat):
+    """Runs function repeat times. Returns timings summary and the result of the last run"""
+    timings = []
+    result = None
+    for i in range(repeat):
+        start = perf_counter()
+        result = function()
+        timings.append(perf_counter() - start)
+    return {'min': min(timings), 'median': statistics.median(timings), 'mean': statistics.mean(timings), 'runs': timings}, result
+
+
+def measure_startup(repeat):
+    """Times a fresh interpreter importing the CLI, which is what every short run pays first"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return measure(lambda: subprocess.check_call([sys.executable, '-c', 'import assfc'], cwd=root), repeat)[0]
+
+
+def run_benchmarks(directory, fonts=200, events=(1000, 20000), repeat=5, workers=1):
+    """Generates the corpus in directory and times every stage separately. Returns OrderedDict benchmark name -> timings.
+    The font cache has to be pointed into directory by the caller, the cold scan discards it"""
+    font_directory = os.path.join(directory, 'fonts')
+    families = generate_font_directory(font_directory, fonts)
+    scripts = OrderedDict()
+    for count in events:
+        scripts['plain_%i' % count] = dict(events=count, override_density=0.05)
+        scripts['overrides_%i' % count] = dict(events=count, override_density=0.6)
+        scripts['karaoke_%i' % count] = dict(events=count, override_density=0.1, karaoke=0.9)
+        scripts['drawings_%i' % count] = dict(events=count, override_density=0.1, drawing=0.5)
+    for name, parameters in scripts.items():
+        path = os.path.join(directory, name + '.ass')
+        generate_script(path, families, **parameters)
+        scripts[name] = path
+
+    results = OrderedDict()
+    results['startup'] = measure_startup(repeat)
+    def cold_scan():
+        FontLoader.discard_cache()
+        return FontLoader([font_directory], False, workers)
+    results['cold_scan'], loader = measure(cold_scan, repeat)
+    results['warm_load'], loader = measure(lambda: FontLoader([font_directory], False, workers), repeat)
+
+    for name, path in scripts.items():
+        results['statistics_' + name], font_list = measure(lambda: AssParser.get_fonts_statistics(path), repeat)
+        results['lookup_' + name], found = measure(lambda: loader.get_fonts_for_list(font_list), repeat)
+    return results
@@ -3,42 +3,215 @@ import os
 from fnmatch import fnmatch
 import logging
 import sys
-import pickle
 import re
+import sqlite3
+import struct
+import threading
+from time import perf_counter
 from font_loader.font_info import FontInfo, FontWeight
 from font_loader.ttf_parser import TTFFont
 from font_loader.ttc_parser import TTCFont
-from misc import get_app_data_folder, enumerate_files_in_directory
+from font_loader.font_cache import FontCache, LayeredFontCache, get_file_stat
+from font_loader.font_index import FontIndex
+from misc import get_app_data_folder, enumerate_files_in_directory, manifest_enumerate_directory, \
+    calculate_md5_for_file, calculate_partial_md5_for_file, create_process_pool
+from misc.file_lock import locked
+from misc.timings import timings
 
 
 is_supported_font = lambda x: os.path.splitext(x)[1].lower() in {'.ttf', '.otf', '.ttc'}
 
-class FontLoader(object):
-    def __init__(self, font_dirs = None, load_system_fonts = True):
-        font_files = set()
-
-        if load_system_fonts:
-            font_files.update(self.enumerate_system_fonts())
+def parse_font_file(path):
+    if fnmatch(path, '*.ttc'):
+        return TTCFont(path).get_infos()
+    return [TTFFont(path).get_info()]
 
-        if font_dirs:
-            for dir in font_dirs:
-                font_files.update(self.enumerate_font_files(dir))
+def scan_font_file(path):
+    #runs in worker processes, so errors and timings are passed back to the parent
+    start = perf_counter()
+    try:
+        return path, parse_font_file(path), None, perf_counter() - start
+    except Exception as e:
+        return path, [], '%s on file %s: %s' % (type(e).__name__, path, e,), perf_counter() - start
 
-        self.__load_fonts(font_files)
+class FontLoader(object):
+    def __init__(self, font_dirs = None, load_system_fonts = True, workers = 1, shared_cache = None, cache_path = None):
+        """shared_cache is a read-only cache (built with cache_path set to it) the per-user cache only records differences to.
+        cache_path replaces the per-user cache, the font index is then kept next to it"""
+        self.workers = workers
+        self.font_dirs = font_dirs
+        self.load_system_fonts = load_system_fonts
+        self.shared_cache = shared_cache
+        if cache_path is None:
+            self.cache_path = FontLoader.get_font_cache_file_path()
+            self.index_path = FontLoader.get_font_index_file_path()
+        else:
+            self.cache_path = cache_path
+            self.index_path = cache_path + '.index'
+        #lookups in progress per index, a replaced index is closed when its last lookup finishes
+        self.__index = None
+        self.__index_users = defaultdict(int)
+        self.__index_lock = threading.Lock()
+        self.reload()
+
+    def reload(self, font_files = None, stats = None):
+        """Brings the cache and the index up to date, parsing only new and modified files. Returns the number of changed files.
+        Without font_files, directories that didn't change since the last walk aren't listed again. Files are always stat'ed,
+        since replacing a file in place doesn't change the mtime of its directory.
+        stats is dict path -> current stat of files the caller has just stat'ed itself.
+        Concurrent processes check the cache under a shared lock and update it under an exclusive one,
+        so a process finding the cache being rebuilt waits for it and then has nothing left to do"""
+        lock_path = self.cache_path + '.lock'
+        waiting = 'Font cache is being updated by another process. Waiting for it to finish...'
+        scan = None
+        with locked(lock_path, False, waiting):
+            #opened without migrating, a cache that is missing, broken or outdated is only recreated under the exclusive lock
+            cache = self.__open_cache(read_only=True)
+            if cache is not None:
+                try:
+                    scan = self.__scan(cache, font_files, stats)
+                    changed = self.__apply(cache, *scan, may_write=False)
+                finally:
+                    cache.close()
+                if changed is not None:
+                    return changed
+        with locked(lock_path, True, waiting):
+            cache = self.__open_cache()
+            try:
+                #the files found under the shared lock are still current, only the cache may have changed meanwhile
+                if scan is None:
+                    scan = self.__scan(cache, font_files, stats)
+                return self.__apply(cache, *scan, may_write=True)
+            finally:
+                cache.close()
+
+    def __scan(self, cache, font_files, stats):
+        """Returns (directories, stats): the directory manifest entries visited (None if font_files were given)
+        and dict path -> stat of all font files"""
+        visited = None
+        if font_files is None:
+            with timings.stage('enumeration'):
+                font_files, visited = self.__enumerate_fonts_with_manifest(cache)
+        stats = stats or {}
+        with timings.stage('file stat', len(font_files)):
+            current = {}
+            for path in font_files:
+                if path in stats:
+                    current[path] = stats[path]
+                    continue
+                try:
+                    current[path] = get_file_stat(path)
+                except OSError as e:
+                    logging.error('%s on file %s: %s' % (type(e).__name__, path, e,))
+        return visited, current
+
+    def __apply(self, cache, visited, current, may_write):
+        """Brings cache and index in line with a scan. Returns the number of changed files,
+        or None if the cache or the index has to be written but may_write is off"""
+        if isinstance(cache, LayeredFontCache):
+            redundant = cache.get_redundant_entries()
+            if redundant != ([], []):
+                if not may_write:
+                    return None
+                logging.debug('Dropping %i files and %i directories the shared font cache has too' % tuple(map(len, redundant)))
+                cache.prune(*redundant)
+        if visited is not None and not self.__update_manifest(cache, visited, may_write):
+            return None
+        return self.__load_fonts(cache, current, may_write)
+
+    def __open_cache(self, read_only = False):
+        """With read_only, returns None if the own cache can't be used without writing to it"""
+        try:
+            cache = FontCache(self.cache_path, read_only)
+        except sqlite3.Error as e:
+            if not read_only:
+                raise
+            logging.debug("Font cache %s can't be read as it is: %s" % (self.cache_path, e))
+            return None
+        if self.shared_cache is None:
+            return cache
+        try:
+            base = FontCache(self.shared_cache, read_only=True)
+        except sqlite3.Error as e:
+            #the own cache alone still gives correct results, it just has to hold everything
+            logging.warning("Couldn't open shared font cache %s: %s" % (self.shared_cache, e))
+            return cache
+        return LayeredFontCache(base, cache)
+
+    def __enumerate_fonts_with_manifest(self, cache):
+        """Returns (font files, dict directory -> manifest entry of all visited directories)"""
+        font_files = set()
+        #normalized so directory paths match the ones of the files found in them
+        roots = [os.path.normpath(x) for x in self.font_dirs or []]
+        if self.load_system_fonts:
+            if sys.platform == 'win32':
+                #system fonts are registered in the registry rather than found by walking directories
+                font_files.update(FontLoader.enumerate_windows_system_fonts())
+            else:
+                roots.extend(os.path.normpath(x) for x in FontLoader.get_system_font_directories())
+
+        manifest = cache.get_directories()
+        visited = {}
+        for root in roots:
+            if root in visited:
+                continue
+            timings = {}
+            files, entries = manifest_enumerate_directory(root, is_supported_font, manifest, timings=timings)
+            FontLoader.log_slowest_directories(root, timings)
+            font_files.update(files)
+            visited.update((path, entry) for path, (entry, unchanged) in entries.items())
+        return font_files, visited
+
+    def __update_manifest(self, cache, visited, may_write):
+        """Returns False if the manifest has to be written but may_write is off"""
+        manifest = cache.get_directories()
+        changed = {path: entry for path, entry in visited.items() if manifest.get(path) != entry}
+        removed = [path for path in manifest if path not in visited]
+        logging.debug('Directory manifest: %i directories, %i changed, %i removed' % (len(visited), len(changed), len(removed)))
+        if (changed or removed) and not may_write:
+            return False
+        if changed:
+            cache.update_directories(changed)
+        if removed:
+            cache.remove_directories(removed)
+        return True
 
     def get_fonts_for_list(self, font_list):
+        with self.__index_lock:
+            index = self.__index
+            self.__index_users[index] += 1
+        try:
+            with timings.stage('matching', len(font_list)):
+                return self.__get_fonts_for_list(index, font_list)
+        finally:
+            with self.__index_lock:
+                self.__index_users[index] -= 1
+                if not self.__index_users[index]:
+                    del self.__index_users[index]
+                    if index is not self.__index:
+                        index.close()
+
+    def __get_fonts_for_list(self, index, font_list):
         found = {}
         not_found = {}
-
-        search_dict = defaultdict(list)
-        for font in self.fonts:
-            for name in font.names:
-                search_dict[name.lower()].append(font)
+        #StyleInfo -> chars used with it that the found font has no glyphs for
+        self.missing_glyphs = {}
+        #StyleInfo -> font of every resolved style, including styles left out of found because another style has the same font
+        self.resolved = {}
+
+        #fonts appended to self.fonts after loading aren't in the persisted index
+        appended = defaultdict(list)
+        if self.__fonts is not None:
+            for font in self.__fonts[self.__loaded_count:]:
+                for name in FontCache.get_index_names(font):
+                    appended[name].append(font)
 
         for font_info in font_list.keys():
             logging.debug('Processing font %s...' % font_info)
-            candidates = search_dict[font_info.fontname.lower()]
-            best_candidate = None
+            name = font_info.fontname.lower()
+            candidates = index.find(name) + appended.get(name, [])
+            #control characters never get glyphs
+            chars = [x for x in font_list[font_info].chars if x >= ' ']
 
             logging.debug('Found %i candidates' % len(candidates))
 
@@ -46,100 +219,290 @@ class FontLoader(object):
                 not_found[font_info] = font_list[font_info]
                 continue
 
-            for candidate in candidates:
-                if candidate.italic == font_info.italic and \
-                   ((font_info.bold == 1 and candidate.bold == True) or
-                   (font_info.bold == 0 and candidate.bold == False) or
-                   candidate.weight == font_info.bold):
-                    best_candidate = candidate
-                    logging.debug("Found exact match")
-                    break
+            exact = [x for x in candidates if FontLoader.__is_exact_match(x, font_info)]
+            best_candidate = FontLoader.__choose_covering_font(exact, chars)
+            if best_candidate:
+                logging.debug("Found exact match")
 
             if not best_candidate:
                 logging.debug('Failed to find exact match. Looking for regular version...')
-                for candidate in candidates:
-                    if candidate.bold == False and candidate.italic == False:
-                        best_candidate = candidate
-                        logging.debug('Found regular one')
-                        break
+                regular = [x for x in candidates if x.bold == False and x.italic == False]
+                best_candidate = FontLoader.__choose_covering_font(regular, chars)
+                if best_candidate:
+                    logging.debug('Found regular one')
 
             if not best_candidate:
                 not_found[font_info] = font_list[font_info]
                 continue
 
+            self.resolved[font_info] = best_candidate
+            missing = best_candidate.get_missing_chars(chars)
+            if missing:
+                self.missing_glyphs[font_info] = missing
+
             if best_candidate in found.values():
                 logging.debug("Font %s already exists" % best_candidate.names[0])
                 continue
 
-            for already_added in found.values():
-                if already_added.md5 == best_candidate.md5:
-                    logging.info("Duplicate font found. Skipping.")
-                    continue
-
             found[font_info] = best_candidate
             logging.debug('Found font %s at %s' % (font_info, best_candidate.path))
+
+        self.__remove_duplicates(found)
         return found, not_found
 
+    @staticmethod
+    def __is_exact_match(candidate, font_info):
+        return candidate.italic == font_info.italic and \
+               ((font_info.bold == 1 and candidate.bold == True) or
+               (font_info.bold == 0 and candidate.bold == False) or
+               candidate.weight == font_info.bold)
 
-    def __load_fonts(self, fonts_paths):
-        cache_file = FontLoader.get_font_cache_file_path()
-        removed = []
-        self.fonts = []
-        try:
-            #let's try to load our cache
-            with open(cache_file, 'rb') as file:
-                cached_fonts = pickle.load(file)
-                #updating the cache - finding all removed/added files
-            cached_paths = frozenset(map(lambda x: x.path, cached_fonts))
-            removed = cached_paths.difference(fonts_paths)
-            added = fonts_paths.difference(cached_paths)
-            self.fonts = list(filter(lambda x: x.path not in removed, cached_fonts))
-        except IOError:
-            logging.debug("Font cache file wasn't found. Will create new one.")
-            #log file wasn't found
-            added = fonts_paths
-
-        for font_path in added:
+    @staticmethod
+    def __choose_covering_font(candidates, chars):
+        """Returns the first of the candidates missing the least glyphs for chars"""
+        if len(candidates) < 2 or not chars:
+            return candidates[0] if candidates else None
+        return min(candidates, key=lambda x: len(x.get_missing_chars(chars)))
+
+    def __remove_duplicates(self, found):
+        """Drops fonts that are the same face as a font found before in a file with the same content.
+        Sizes are compared first, then partial hashes, full hashes are calculated only when those collide"""
+        def collisions(fonts, key):
+            groups = defaultdict(list)
+            for font in fonts:
+                if key(font) is not None:
+                    groups[key(font)].append(font)
+            return [font for group in groups.values() if len(set(x.path for x in group)) > 1 for font in group]
+
+        sizes = {}
+        for font in found.values():
             try:
-                if fnmatch(font_path, '*.ttc'):
-                    self.fonts.extend(TTCFont(font_path).get_infos())
-                else:
-                    self.fonts.append(TTFFont(font_path).get_info())
-            except Exception as e:
-                logging.error('%s on file %s: %s' % (type(e).__name__, font_path, e,))
+                sizes[font.path] = os.path.getsize(font.path)
+            except OSError:
+                pass
+        fonts = collisions(found.values(), lambda x: sizes.get(x.path))
+        if not fonts:
+            return
+
+        partial = self.get_file_hashes(set(x.path for x in fonts), False)
+        fonts = collisions(fonts, lambda x: partial.get(x.path))
+        if not fonts:
+            return
+
+        full = self.get_file_hashes(set(x.path for x in fonts), True)
+        seen = {}
+        for font_info, font in list(found.items()):
+            if font.path not in full:
+                continue
+            font.md5 = full[font.path]
+            key = (font.md5, tuple(font.names))
+            kept = seen.setdefault(key, font)
+            if kept.path != font.path:
+                logging.info("Duplicate font found. Skipping %s" % font.path)
+                del found[font_info]
+                for style, resolved in self.resolved.items():
+                    if resolved is font:
+                        self.resolved[style] = kept
+
+    def get_file_hashes(self, paths, full):
+        """Returns dict path -> full or partial md5. Hashes are calculated in parallel and kept in the font cache"""
+        lock_path = self.cache_path + '.lock'
+        stored = {}
+        with locked(lock_path, False):
+            cache = self.__open_cache(read_only=True)
+            if cache is not None:
+                try:
+                    stored = cache.get_hashes(paths)
+                finally:
+                    cache.close()
+        hashes = {}
+        missing = {}
+        for path in paths:
+            try:
+                size, mtime, inode = get_file_stat(path)
+            except OSError:
+                continue
+            entry = stored.get(path)
+            if entry is None or entry[:2] != (size, mtime):
+                entry = (size, mtime, None, None)
+            value = entry[3] if full else entry[2]
+            if value is None:
+                missing[path] = entry
+            else:
+                hashes[path] = value
+        if not missing:
+            return hashes
+
+        from concurrent.futures import ThreadPoolExecutor
+        function = calculate_md5_for_file if full else calculate_partial_md5_for_file
+        with ThreadPoolExecutor(min(8, len(missing))) as executor:
+            results = list(executor.map(function, missing.keys()))
+        updated = {}
+        for (path, entry), value in zip(missing.items(), results):
+            hashes[path] = value
+            updated[path] = entry[:3] + (value,) if full else entry[:2] + (value, entry[3])
+        with locked(lock_path):
+            cache = self.__open_cache()
+            try:
+                cache.update_hashes(updated)
+            finally:
+                cache.close()
+        return hashes
+
+
+    def __load_fonts(self, cache, current, may_write):
+        with timings.stage('cache load', len(current)):
+            cached = cache.get_stats()
+
+        #a file is rescanned if it was added or its size/mtime/inode changed
+        removed = [path for path in cached if path not in current]
+        changed = [path for path, stat in current.items() if cached.get(path) != stat]
+        logging.debug('Font cache: %i removed, %i new or modified files' % (len(removed), len(changed)))
+        if (removed or changed) and not may_write:
+            return None
+
+        with timings.stage('font parsing', len(changed)):
+            parsed = FontLoader.scan_fonts(changed, self.workers)
+        with timings.stage('cache write', len(removed) + len(changed)):
+            if removed:
+                cache.remove(removed)
+            if changed:
+                #broken files are stored without fonts so they aren't parsed again until modified
+                cache.update({path: (current[path], parsed.get(path, [])) for path in changed})
+
+        cache_id, generation = cache.get_cache_id(), cache.get_generation()
+        with timings.stage('index load'):
+            index = FontLoader.__open_index(self.index_path, cache_id, generation)
+        if index is None:
+            if not may_write:
+                return None
+            logging.debug('Font index is missing or outdated. Rebuilding it.')
+            with timings.stage('index write'):
+                FontIndex.write(self.index_path, cache_id, generation, cache.get_fonts(), cache.get_name_index())
+                index = FontIndex(self.index_path)
+        #lookups running in other threads keep using the old index, the last of them closes it
+        with self.__index_lock:
+            old, self.__index = self.__index, index
+            if old is not None and old is not index and not self.__index_users[old]:
+                del self.__index_users[old]
+                old.close()
+        self.__fonts = None
+        return len(removed) + len(changed)
+
+    @staticmethod
+    def __open_index(path, cache_id, generation):
+        try:
+            index = FontIndex(path)
+        except (OSError, ValueError, struct.error):
+            return None
+        if (index.cache_id, index.generation) != (cache_id, generation):
+            index.close()
+            return None
+        return index
+
+    @property
+    def fonts(self):
+        """List of all known fonts. Loaded from the cache on first access, lookups don't need it"""
+        if self.__fonts is None:
+            lock_path = self.cache_path + '.lock'
+            with locked(lock_path, False):
+                cache = self.__open_cache(read_only=True)
+                if cache is not None:
+                    try:
+                        fonts = cache.get_fonts()
+                    finally:
+                        cache.close()
+            if cache is None:
+                #a cache that has to be migrated first is only written under the exclusive lock, like in reload
+                with locked(lock_path):
+                    cache = self.__open_cache()
+                    try:
+                        fonts = cache.get_fonts()
+                    finally:
+                        cache.close()
+            self.__fonts = [info for infos in fonts.values() for info in infos]
+            self.__loaded_count = len(self.__fonts)
+        return self.__fonts
 
 
-        if added or removed:
-            # updating the cache
-            with open(cache_file, 'wb') as file:
-                pickle.dump(self.fonts, file, -1)
+    @staticmethod
+    def scan_fonts(paths, workers = 1):
+        """Parses font files, in parallel if workers > 1 (0 means one per CPU). Returns dict path -> [FontInfo]"""
+        paths = list(paths)
+        if not workers:
+            workers = os.cpu_count() or 1
+        if workers > 1 and len(paths) > 1:
+            logging.debug('Scanning %i font files using %i workers' % (len(paths), workers))
+            with create_process_pool(workers) as executor:
+                results = list(executor.map(scan_font_file, paths, chunksize=max(1, len(paths) // (workers * 8))))
+        else:
+            results = map(scan_font_file, paths)
+
+        fonts = {}
+        for path, infos, error, elapsed in results:
+            timings.add_item('font files', path, elapsed)
+            if error:
+                logging.error(error)
+            else:
+                fonts[path] = infos
+        return fonts
+
+
+    @staticmethod
+    def enumerate_fonts(font_dirs, load_system_fonts):
+        font_files = set()
+
+        if load_system_fonts:
+            font_files.update(FontLoader.enumerate_system_fonts())
+
+        if font_dirs:
+            for dir in font_dirs:
+                font_files.update(FontLoader.enumerate_font_files(dir))
+        return font_files
 
 
     @staticmethod
     def enumerate_font_files(directory):
-        files =  enumerate_files_in_directory(directory)
-        return [x for x in files if is_supported_font(x)]
+        timings = {}
+        files = enumerate_files_in_directory(directory, is_supported_font, timings)
+        FontLoader.log_slowest_directories(directory, timings)
+        return files
+
+    @staticmethod
+    def log_slowest_directories(directory, timings):
+        if timings:
+            slowest = sorted(timings.items(), key=lambda x: x[1], reverse=True)[:5]
+            logging.debug('Listed %i directories in %s, slowest: %s' % (len(timings), directory,
+                          ', '.join('%s (%.3fs)' % x for x in slowest)))
 
 
     @staticmethod
-    def enumerate_linux_system_fonts():
+    def get_linux_system_font_directories():
         linux_font_dir = re.compile(r'<dir( prefix="xdg")?>(.+?)</dir>')
         with open('/etc/fonts/fonts.conf') as file:
             folders = linux_font_dir.findall(file.read())
-        paths = []
+        directories = []
         for has_xdg, f in folders:
             if has_xdg:
                 f = (os.environ.get('XDG_FONT_DIRS') or f"{os.environ.get('XDG_DATA_HOME') or os.environ['HOME'] + '/.local/share'}") + f'/{f}'
             elif f.startswith('~'):
                 f = os.environ['HOME'] + f[1:]
+            directories.append(f)
+        return directories
+
+    @staticmethod
+    def enumerate_linux_system_fonts():
+        paths = []
+        for f in FontLoader.get_linux_system_font_directories():
             paths.extend(FontLoader.enumerate_font_files(f))
         return paths
 
+    osx_system_font_directories = ['/System/Library/Fonts', '/Library/Fonts', '~/Library/Fonts', '/Network/Library/Fonts']
+
     @staticmethod
     def enumerate_osx_system_fonts():
-        folders = ['/System/Library/Fonts', '/Library/Fonts', '~/Library/Fonts', '/Network/Library/Fonts']
         paths = []
-        for f in folders:
+        for f in FontLoader.osx_system_font_directories:
             try:
                 paths.extend(FontLoader.enumerate_font_files(f))
             except IOError:
@@ -172,14 +535,29 @@ class FontLoader(object):
             return FontLoader.enumerate_linux_system_fonts()
 
 
+    @staticmethod
+    def get_system_font_directories():
+        if sys.platform == 'win32':
+            return [os.path.join(os.environ['SYSTEMROOT'], 'Fonts')]
+        elif sys.platform == 'darwin':
+            return [os.path.expanduser(x) for x in FontLoader.osx_system_font_directories]
+        else:
+            return FontLoader.get_linux_system_font_directories()
+
+
     @staticmethod
     def discard_cache():
-        cache = FontLoader.get_font_cache_file_path()
-        if os.path.exists(cache):
-            os.remove(cache)
+        with locked(FontLoader.get_font_cache_file_path() + '.lock'):
+            FontCache.discard(FontLoader.get_font_cache_file_path())
+            FontCache.discard(FontLoader.get_font_index_file_path())
 
 
     @staticmethod
     def get_font_cache_file_path():
-        return os.path.join(get_app_data_folder(), "font_cache.bin")
+        return os.path.join(get_app_data_folder(), "font_cache.db")
+
+
+    @staticmethod
+    def get_font_index_file_path():
+        return os.path.join(get_app_data_folder(), "font_index.bin")
 
@@ -0,0 +1,112 @@
+from array import array
+import struct
+
+#(platform id, encoding id) of unicode subtables, best first. (3, 0) is the symbol encoding
+preferred_subtables = [(3, 10), (0, 6), (0, 4), (3, 1), (0, 3), (0, 2), (0, 1), (0, 0), (3, 0)]
+supported_formats = {4, 12}
+
+
+def find_unicode_subtable(data, cmap_offset):
+    """Returns (platform id, encoding id, absolute offset) of the best supported unicode subtable or None"""
+    version, num_tables = struct.unpack_from('>HH', data, cmap_offset)
+    records = struct.unpack_from('>%iH' % (num_tables * 4), data, cmap_offset + 4)
+    subtables = {}
+    for index in range(0, len(records), 4):
+        platform_id, encoding_id, high, low = records[index:index + 4]
+        offset = cmap_offset + (high << 16 | low)
+        if struct.unpack_from('>H', data, offset)[0] in supported_formats:
+            subtables.setdefault((platform_id, encoding_id), offset)
+    for key in preferred_subtables:
+        if key in subtables:
+            return key + (subtables[key],)
+    return None
+
+
+def iterate_format_4_segments(data, offset):
+    """Yields (start, end, glyph id function) for all segments of a format 4 subtable"""
+    seg_count = struct.unpack_from('>H', data, offset + 6)[0] // 2
+    ends = struct.unpack_from('>%iH' % seg_count, data, offset + 14)
+    starts = struct.unpack_from('>%iH' % seg_count, data, offset + 16 + seg_count * 2)
+    deltas = struct.unpack_from('>%iH' % seg_count, data, offset + 16 + seg_count * 4)
+    range_offsets_pos = offset + 16 + seg_count * 6
+    range_offsets = struct.unpack_from('>%iH' % seg_count, data, range_offsets_pos)
+
+    for index in range(seg_count):
+        start, end, delta, range_offset = starts[index], ends[index], deltas[index], range_offsets[index]
+        if start > end or start == 0xFFFF:
+            continue
+        if range_offset == 0:
+            get_glyph = lambda char, delta=delta: (char + delta) & 0xFFFF
+        else:
+            base = range_offsets_pos + index * 2 + range_offset
+            def get_glyph(char, base=base, start=start, delta=delta):
+                glyph = struct.unpack_from('>H', data, base + (char - start) * 2)[0]
+                return (glyph + delta) & 0xFFFF if glyph else 0
+        yield start, end, get_glyph, range_offset == 0
+
+
+def iterate_format_12_groups(data, offset):
+    """Yields (start, end, start glyph id) for all groups of a format 12 subtable"""
+    num_groups = struct.unpack_from('>I', data, offset + 12)[0]
+    groups = struct.unpack_from('>%iI' % (num_groups * 3), data, offset + 16)
+    for index in range(0, len(groups), 3):
+        yield groups[index:index + 3]
+
+
+def merge_ranges(ranges):
+    """Takes list of (start, end) inclusive ranges, returns flat array of sorted non-overlapping [start, end + 1) pairs"""
+    coverage = array('I')
+    for start, end in sorted(ranges):
+        if coverage and start <= coverage[-1]:
+            coverage[-1] = max(coverage[-1], end + 1)
+        else:
+            coverage.append(start)
+            coverage.append(end + 1)
+    return coverage
+
+
+def get_coverage(data, cmap_offset):
+    """Returns coverage of the font as produced by merge_ranges or None if there's no supported unicode subtable"""
+    subtable = find_unicode_subtable(data, cmap_offset)
+    if subtable is None:
+        return None
+    platform_id, encoding_id, offset = subtable
+
+    ranges = []
+    if struct.unpack_from('>H', data, offset)[0] == 12:
+        for start, end, glyph in iterate_format_12_groups(data, offset):
+            ranges.append((start, end))
+    else:
+        for start, end, get_glyph, contiguous in iterate_format_4_segments(data, offset):
+            if contiguous:
+                ranges.append((start, end))
+                continue
+            for char in range(start, end + 1):
+                if get_glyph(char):
+                    ranges.append((char, char))
+
+    if (platform_id, encoding_id) == (3, 0):
+        #symbol fonts map their glyphs to U+F000-U+F0FF, but renderers also use them for U+0000-U+00FF
+        ranges.extend((max(start, 0xF000) - 0xF000, min(end, 0xF0FF) - 0xF000) for start, end in list(ranges)
+                      if start <= 0xF0FF and end >= 0xF000)
+    return merge_ranges(ranges)
+
+
+def get_glyph_map(data, cmap_offset):
+    """Returns (platform id, encoding id, dict code point -> glyph id) of the best unicode subtable or None"""
+    subtable = find_unicode_subtable(data, cmap_offset)
+    if subtable is None:
+        return None
+    platform_id, encoding_id, offset = subtable
+
+    glyphs = {}
+    if struct.unpack_from('>H', data, offset)[0] == 12:
+        for start, end, glyph in iterate_format_12_groups(data, offset):
+            glyphs.update(zip(range(start, end + 1), range(glyph, glyph + end - start + 1)))
+    else:
+        for start, end, get_glyph, contiguous in iterate_format_4_segments(data, offset):
+            for char in range(start, end + 1):
+                glyph = get_glyph(char)
+                if glyph:
+                    glyphs[char] = glyph
+    return platform_id, encoding_id, glyphs
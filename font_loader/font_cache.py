@@ -0,0 +1,260 @@
+import logging
+import os
+import pickle
+import random
+import sqlite3
+
+
+def get_file_stat(path):
+    stat = os.stat(path)
+    #st_ino is 0 on platforms that don't have inodes, which is fine for comparison purposes
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class FontCache(object):
+    """Font cache stored in SQLite, one row per font file, so changing a single font costs a single row write"""
+    #bump when the schema changes, old caches are dropped and rebuilt
+    schema_version = 6
+    tables = ['fonts', 'names', 'meta', 'directories', 'hashes']
+
+    def __init__(self, path, read_only = False):
+        """read_only caches are never modified, and raise instead of being recreated when they are broken or outdated"""
+        self.path = path
+        self.read_only = read_only
+        if read_only:
+            self.__connect_read_only()
+            return
+        try:
+            self.__connect()
+        except sqlite3.DatabaseError as e:
+            logging.warning('Font cache file %s is broken (%s). Will create new one.' % (path, e))
+            self.connection.close()
+            FontCache.discard(path)
+            self.__connect()
+
+    def __connect_read_only(self):
+        from urllib.request import pathname2url
+        self.connection = sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(self.path)), uri=True)
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != self.schema_version:
+            self.connection.close()
+            raise sqlite3.DatabaseError('Font cache %s was built by a different version' % self.path)
+
+    def __connect(self):
+        self.connection = sqlite3.connect(self.path)
+        with self.connection:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != self.schema_version:
+                for table in self.tables:
+                    self.connection.execute('DROP TABLE IF EXISTS %s' % table)
+                self.connection.execute('PRAGMA user_version = %i' % self.schema_version)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fonts '
+                                    '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, infos BLOB)')
+            #lowercase name -> position of the FontInfo in the infos list of the file
+            self.connection.execute('CREATE TABLE IF NOT EXISTS names (name TEXT, path TEXT, position INTEGER)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS names_by_name ON names (name)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS names_by_path ON names (path)')
+            #generation is incremented on every change so derived files (like the font index) can detect they are stale
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+            #generations restart at 0 when the cache is recreated, the random id tells the new cache from the old one
+            self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('cache_id', ?)", (random.getrandbits(32),))
+            #directory manifest: mtime and font files/subdirectories of every font directory seen on the last walk
+            self.connection.execute('CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime INTEGER, files BLOB, subdirs BLOB)')
+            #partial and full md5 of font files, valid while size and mtime match
+            self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, partial TEXT, md5 TEXT)')
+
+    def close(self):
+        self.connection.close()
+
+    def get_stats(self):
+        """Returns dict path -> (size, mtime, inode) of all cached files"""
+        rows = self.connection.execute('SELECT path, size, mtime, inode FROM fonts')
+        return {path: (size, mtime, inode) for path, size, mtime, inode in rows}
+
+    def get_fonts(self):
+        """Returns dict path -> [FontInfo] of all cached files"""
+        rows = self.connection.execute('SELECT path, infos FROM fonts')
+        return {path: pickle.loads(infos) for path, infos in rows}
+
+    def get_generation(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def get_cache_id(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'cache_id'").fetchone()
+        return row[0] if row else 0
+
+    def __increment_generation(self):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (self.get_generation() + 1,))
+
+    def get_name_index(self):
+        """Returns all (lowercase name, path, position) entries of the name index"""
+        return self.connection.execute('SELECT name, path, position FROM names ORDER BY rowid').fetchall()
+
+    def update(self, fonts):
+        """Takes dict path -> (stat, [FontInfo])"""
+        rows = ((path, stat[0], stat[1], stat[2], pickle.dumps(infos, -1)) for path, (stat, infos) in fonts.items())
+        names = ((name, path, position) for path, (stat, infos) in fonts.items()
+                                        for position, info in enumerate(infos)
+                                        for name in FontCache.get_index_names(info))
+        with self.connection:
+            self.connection.executemany('DELETE FROM names WHERE path = ?', ((path,) for path in fonts))
+            self.connection.executemany('DELETE FROM hashes WHERE path = ?', ((path,) for path in fonts))
+            self.connection.executemany('INSERT OR REPLACE INTO fonts VALUES (?, ?, ?, ?, ?)', rows)
+            self.connection.executemany('INSERT INTO names VALUES (?, ?, ?)', names)
+            self.__increment_generation()
+
+    def remove(self, paths):
+        paths = [(path,) for path in paths]
+        with self.connection:
+            self.connection.executemany('DELETE FROM names WHERE path = ?', paths)
+            self.connection.executemany('DELETE FROM hashes WHERE path = ?', paths)
+            self.connection.executemany('DELETE FROM fonts WHERE path = ?', paths)
+            self.__increment_generation()
+
+    def get_hashes(self, paths):
+        """Returns dict path -> (size, mtime, partial md5, md5) for given paths, hashes that weren't calculated are None"""
+        hashes = {}
+        for path in paths:
+            row = self.connection.execute('SELECT size, mtime, partial, md5 FROM hashes WHERE path = ?', (path,)).fetchone()
+            if row:
+                hashes[path] = row
+        return hashes
+
+    def update_hashes(self, hashes):
+        """Takes dict path -> (size, mtime, partial md5, md5)"""
+        rows = ((path,) + tuple(value) for path, value in hashes.items())
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', rows)
+
+    def get_directories(self):
+        """Returns dict path -> (mtime, files, subdirs) of the directory manifest"""
+        rows = self.connection.execute('SELECT path, mtime, files, subdirs FROM directories')
+        return {path: (mtime, pickle.loads(files), pickle.loads(subdirs)) for path, mtime, files, subdirs in rows}
+
+    def update_directories(self, directories):
+        """Takes dict path -> (mtime, files, subdirs)"""
+        rows = ((path, mtime, pickle.dumps(files, -1), pickle.dumps(subdirs, -1)) for path, (mtime, files, subdirs) in directories.items())
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)', rows)
+
+    def remove_directories(self, paths):
+        with self.connection:
+            self.connection.executemany('DELETE FROM directories WHERE path = ?', ((path,) for path in paths))
+
+    def get_hidden_paths(self):
+        """Returns paths of font files recorded as removed. Only layered caches write such entries"""
+        return set(row[0] for row in self.connection.execute('SELECT path FROM fonts WHERE size IS NULL'))
+
+    def get_hidden_directories(self):
+        return set(row[0] for row in self.connection.execute('SELECT path FROM directories WHERE mtime IS NULL'))
+
+    @staticmethod
+    def get_index_names(info):
+        return set(name.lower() for name in info.names)
+
+    @staticmethod
+    def discard(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class LayeredFontCache(object):
+    """Read-only shared cache with a per-user overlay on top. Has the interface of FontCache.
+    The overlay stores only files and directories that differ from the base, and entries hiding base files
+    the user doesn't have (stored with NULL size or mtime). Entries matching the base are dropped from the overlay"""
+
+    def __init__(self, base, overlay):
+        self.base = base
+        self.overlay = overlay
+        self.path = overlay.path
+
+    def close(self):
+        self.base.close()
+        self.overlay.close()
+
+    def get_redundant_entries(self):
+        """Returns (paths, directories) the overlay holds just like the base, as a cache used before layering does"""
+        base = self.base.get_stats()
+        paths = [path for path, stat in self.overlay.get_stats().items() if stat[0] is not None and base.get(path) == stat]
+        base_directories = self.base.get_directories()
+        directories = [path for path, entry in self.overlay.get_directories().items()
+                       if entry[0] is not None and base_directories.get(path) == entry]
+        return paths, directories
+
+    def prune(self, paths, directories):
+        if paths:
+            self.overlay.remove(paths)
+        if directories:
+            self.overlay.remove_directories(directories)
+
+    def get_stats(self):
+        stats = self.base.get_stats()
+        stats.update(self.overlay.get_stats())
+        return {path: stat for path, stat in stats.items() if stat[0] is not None}
+
+    def get_fonts(self):
+        hidden = self.overlay.get_hidden_paths()
+        fonts = self.base.get_fonts()
+        fonts.update(self.overlay.get_fonts())
+        return {path: infos for path, infos in fonts.items() if path not in hidden}
+
+    def get_generation(self):
+        """Changes when either layer changes, including the base being rebuilt"""
+        import zlib
+        key = '%s:%i:%i:%i' % (self.base.path, os.stat(self.base.path).st_mtime_ns, self.base.get_generation(), self.overlay.get_generation())
+        return zlib.crc32(key.encode('utf-8'))
+
+    def get_cache_id(self):
+        #the generation already changes when the base is rebuilt
+        return self.overlay.get_cache_id()
+
+    def get_name_index(self):
+        overridden = set(self.overlay.get_stats().keys())
+        return [row for row in self.base.get_name_index() if row[1] not in overridden] + self.overlay.get_name_index()
+
+    def update(self, fonts):
+        base = self.base.get_stats()
+        restored = [path for path, (stat, infos) in fonts.items() if base.get(path) == stat]
+        changed = {path: value for path, value in fonts.items() if base.get(path) != value[0]}
+        if restored:
+            self.overlay.remove(restored)
+        if changed:
+            self.overlay.update(changed)
+
+    def remove(self, paths):
+        base = self.base.get_stats()
+        hidden = {path: ((None, None, None), []) for path in paths if path in base}
+        own = [path for path in paths if path not in base]
+        if hidden:
+            self.overlay.update(hidden)
+        if own:
+            self.overlay.remove(own)
+
+    def get_hashes(self, paths):
+        return self.overlay.get_hashes(paths)
+
+    def update_hashes(self, hashes):
+        self.overlay.update_hashes(hashes)
+
+    def get_directories(self):
+        hidden = self.overlay.get_hidden_directories()
+        directories = self.base.get_directories()
+        directories.update(self.overlay.get_directories())
+        return {path: entry for path, entry in directories.items() if path not in hidden}
+
+    def update_directories(self, directories):
+        base = self.base.get_directories()
+        restored = [path for path, entry in directories.items() if base.get(path) == entry]
+        changed = {path: entry for path, entry in directories.items() if base.get(path) != entry}
+        if restored:
+            self.overlay.remove_directories(restored)
+        if changed:
+            self.overlay.update_directories(changed)
+
+    def remove_directories(self, paths):
+        base = self.base.get_directories()
+        hidden = {path: (None, [], []) for path in paths if path in base}
+        own = [path for path in paths if path not in base]
+        if hidden:
+            self.overlay.update_directories(hidden)
+        if own:
+            self.overlay.remove_directories(own)
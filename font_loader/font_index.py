@@ -0,0 +1,142 @@
+from array import array
+from collections import defaultdict
+import mmap
+import os
+import struct
+from font_loader.font_info import FontInfo
+
+# File layout (all integers little-endian):
+#   header:  magic, format version, cache id, cache generation, name count, offset of the name table
+#   names:   sorted (name offset, name length, candidates offset, candidates count) entries
+#   strings: utf-8 encoded lowercase names
+#   candidates: uint32 offsets of records, in index order
+#   records: flags (bold, italic, has coverage), weight, path length, names count, fs-encoded path, (length, utf-8 name) * count,
+#            coverage length, uint32 coverage values
+Header = struct.Struct('<4sIIIII')
+NameEntry = struct.Struct('<IIII')
+Record = struct.Struct('<BHHH')
+NameLength = struct.Struct('<H')
+CoverageLength = struct.Struct('<I')
+
+
+class FontIndex(object):
+    """Memory-mapped name -> FontInfo index. Only records of the looked up names are ever decoded"""
+    magic = b'AFCI'
+    version = 3
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.__data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.cache_id, self.generation, self.__count, self.__names_offset = Header.unpack_from(self.__data, 0)
+        if magic != self.magic or version != self.version:
+            self.close()
+            raise ValueError('Not a font index file or unsupported version')
+        #records are decoded once so the same font is always the same FontInfo object
+        self.__records = {}
+
+    def close(self):
+        self.__data.close()
+
+    def __len__(self):
+        return self.__count
+
+    def find(self, name):
+        """Returns list of FontInfo for lowercase font name"""
+        key = name.lower().encode('utf-8')
+        data = self.__data
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            name_offset, name_length, _, _ = NameEntry.unpack_from(data, self.__names_offset + middle * NameEntry.size)
+            if data[name_offset:name_offset + name_length] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.__count:
+            return []
+
+        name_offset, name_length, candidates_offset, candidates_count = NameEntry.unpack_from(data, self.__names_offset + low * NameEntry.size)
+        if data[name_offset:name_offset + name_length] != key:
+            return []
+        offsets = struct.unpack_from('<%iI' % candidates_count, data, candidates_offset)
+        return [self.__get_record(offset) for offset in offsets]
+
+    def __get_record(self, offset):
+        try:
+            return self.__records[offset]
+        except KeyError:
+            pass
+        data = self.__data
+        flags, weight, path_length, names_count = Record.unpack_from(data, offset)
+        pos = offset + Record.size
+        path = os.fsdecode(data[pos:pos + path_length])
+        pos += path_length
+        names = []
+        for i in range(names_count):
+            length = NameLength.unpack_from(data, pos)[0]
+            pos += NameLength.size
+            names.append(data[pos:pos + length].decode('utf-8'))
+            pos += length
+        coverage = None
+        length = CoverageLength.unpack_from(data, pos)[0]
+        if flags & 4:
+            coverage = array('I', struct.unpack_from('<%iI' % length, data, pos + CoverageLength.size))
+        info = FontInfo(names, bool(flags & 1), bool(flags & 2), weight, path, None, coverage)
+        self.__records[offset] = info
+        return info
+
+    @staticmethod
+    def write(path, cache_id, generation, fonts, name_index):
+        """fonts is dict path -> [FontInfo], name_index is a list of (lowercase name, path, position).
+        cache_id and generation identify the state of the cache the index was built from"""
+        records = bytearray()
+        record_offsets = {}
+        for font_path, infos in fonts.items():
+            for position, info in enumerate(infos):
+                record_offsets[(font_path, position)] = len(records)
+                encoded_path = os.fsencode(info.path)
+                coverage = info.coverage if info.coverage is not None else []
+                records += Record.pack((1 if info.bold else 0) | (2 if info.italic else 0) | (4 if info.coverage is not None else 0),
+                                       info.weight, len(encoded_path), len(info.names))
+                records += encoded_path
+                for name in info.names:
+                    encoded = name.encode('utf-8')
+                    records += NameLength.pack(len(encoded))
+                    records += encoded
+                records += CoverageLength.pack(len(coverage))
+                records += struct.pack('<%iI' % len(coverage), *coverage)
+
+        candidates = defaultdict(list)
+        for name, font_path, position in name_index:
+            candidates[name.encode('utf-8')].append(record_offsets[(font_path, position)])
+        names = sorted(candidates.keys())
+
+        names_offset = Header.size
+        strings_offset = names_offset + len(names) * NameEntry.size
+        strings_size = sum(len(name) for name in names)
+        candidates_offset = strings_offset + strings_size
+        records_offset = candidates_offset + sum(len(x) for x in candidates.values()) * 4
+
+        table = bytearray()
+        strings = bytearray()
+        lists = bytearray()
+        for name in names:
+            offsets = candidates[name]
+            table += NameEntry.pack(strings_offset + len(strings), len(name), candidates_offset + len(lists), len(offsets))
+            strings += name
+            lists += struct.pack('<%iI' % len(offsets), *(records_offset + x for x in offsets))
+
+        #unique temp file, so processes writing at the same time never write into one file
+        import tempfile
+        handle, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(Header.pack(FontIndex.magic, FontIndex.version, cache_id, generation, len(names), names_offset))
+                file.write(table)
+                file.write(strings)
+                file.write(lists)
+                file.write(records)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
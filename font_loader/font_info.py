@@ -1,15 +1,26 @@
+from bisect import bisect_right
 from misc import calculate_md5_for_file
 
 class FontInfo(object):
-    __slots__ = ['names', 'bold', 'italic', 'weight', 'path', '__md5']
+    __slots__ = ['names', 'bold', 'italic', 'weight', 'path', '__md5', 'coverage']
 
-    def __init__(self, names, bold, italic, weight, path, md5):
+    def __init__(self, names, bold, italic, weight, path, md5, coverage = None):
         self.names = names
         self.bold = bold
         self.italic = italic
         self.weight = weight
         self.path = path
         self.__md5 = md5
+        #flat array of sorted [start, end) code point ranges the font has glyphs for, None if unknown
+        self.coverage = coverage
+
+    def get_missing_chars(self, chars):
+        """Returns set of chars the font has no glyphs for. Fonts with unknown coverage are assumed to have everything"""
+        if self.coverage is None:
+            return set()
+        coverage = self.coverage
+        #a code point is covered if it falls after a range start, i.e. at an odd position
+        return set(char for char in chars if not bisect_right(coverage, ord(char)) & 1)
 
     @property
     def md5(self):
@@ -17,6 +28,10 @@ class FontInfo(object):
             self.__md5 = calculate_md5_for_file(self.path)
         return self.__md5
 
+    @md5.setter
+    def md5(self, value):
+        self.__md5 = value
+
 class FontWeight(object):
     FW_UNDEFINED = 0
     FW_THIN = 100
@@ -0,0 +1,259 @@
+from array import array
+import os
+import shutil
+import struct
+import sys
+from font_loader.cmap_parser import get_glyph_map
+from font_loader.ttf_parser import TTFFont, map_font_file
+
+#composite glyph flags
+ARG_1_AND_2_ARE_WORDS = 0x0001
+WE_HAVE_A_SCALE = 0x0008
+MORE_COMPONENTS = 0x0020
+WE_HAVE_AN_X_AND_Y_SCALE = 0x0040
+WE_HAVE_A_TWO_BY_TWO = 0x0080
+
+#tables holding data of every glyph that would go stale, none of them are required
+dropped_tables = {b'DSIG', b'hdmx', b'LTSH', b'VDMX'}
+
+
+class SubsetError(Exception):
+    pass
+
+
+def read_table_directory(data, offset):
+    """Returns sfnt version and dict tag -> (offset, length) of the font starting at offset"""
+    version, num_tables = struct.unpack_from('>IH', data, offset)
+    tables = {}
+    for index in range(num_tables):
+        tag, check_sum, table_offset, length = struct.unpack_from('>4sLLL', data, offset + 12 + index * 16)
+        tables[tag] = (table_offset, length)
+    return version, tables
+
+
+def find_font(data, info):
+    """Returns (index in collection, offset) of the font described by info inside a font file. Index is None unless it's a collection"""
+    if data[:4] != b'ttcf':
+        return None, 0
+    num_fonts = struct.unpack_from('>L', data, 8)[0]
+    for index, offset in enumerate(struct.unpack_from('>%iI' % num_fonts, data, 12)):
+        member = TTFFont(info.path, offset, data).get_info()
+        if set(member.names) == set(info.names) and (member.bold, member.italic) == (info.bold, info.italic):
+            return index, offset
+    raise SubsetError('Font %s not found in collection %s' % (info.names, info.path))
+
+
+def get_glyph_components(glyph):
+    """Returns glyph ids referenced by a composite glyph"""
+    components = []
+    if len(glyph) < 10 or struct.unpack_from('>h', glyph, 0)[0] >= 0:
+        return components
+    pos = 10
+    while True:
+        flags, component = struct.unpack_from('>HH', glyph, pos)
+        components.append(component)
+        pos += 4 + (4 if flags & ARG_1_AND_2_ARE_WORDS else 2)
+        if flags & WE_HAVE_A_SCALE:
+            pos += 2
+        elif flags & WE_HAVE_AN_X_AND_Y_SCALE:
+            pos += 4
+        elif flags & WE_HAVE_A_TWO_BY_TWO:
+            pos += 8
+        if not flags & MORE_COMPONENTS:
+            return components
+
+
+def get_used_codes(chars, platform_id, encoding_id):
+    codes = {ord(x) for x in chars}
+    codes.add(0x20)
+    if (platform_id, encoding_id) == (3, 0):
+        #same remapping renderers do for symbol fonts
+        codes.update(x + 0xF000 for x in list(codes) if x <= 0xFF)
+    return codes
+
+
+def build_format_4_subtable(glyph_map):
+    segments = []
+    for code in sorted(x for x in glyph_map if x < 0xFFFF):
+        delta = glyph_map[code] - code
+        if segments and segments[-1][1] == code - 1 and segments[-1][2] == delta:
+            segments[-1][1] = code
+        else:
+            segments.append([code, code, delta])
+    segments.append([0xFFFF, 0xFFFF, 1])
+
+    seg_count = len(segments)
+    length = 16 + seg_count * 8
+    if length > 0xFFFF:
+        return None
+    search_range = 2 ** (seg_count.bit_length() - 1) * 2
+    data = struct.pack('>7H', 4, length, 0, seg_count * 2, search_range, search_range.bit_length() - 2, seg_count * 2 - search_range)
+    data += struct.pack('>%iH' % seg_count, *(x[1] for x in segments))
+    data += b'\0\0'
+    data += struct.pack('>%iH' % seg_count, *(x[0] for x in segments))
+    data += struct.pack('>%iH' % seg_count, *(x[2] & 0xFFFF for x in segments))
+    data += struct.pack('>%iH' % seg_count, *([0] * seg_count))
+    return data
+
+
+def build_format_12_subtable(glyph_map):
+    groups = []
+    for code in sorted(glyph_map):
+        glyph = glyph_map[code]
+        if groups and groups[-1][1] == code - 1 and groups[-1][2] + code - groups[-1][0] == glyph:
+            groups[-1][1] = code
+        else:
+            groups.append([code, code, glyph])
+    data = struct.pack('>HHIII', 12, 0, 16 + len(groups) * 12, 0, len(groups))
+    for group in groups:
+        data += struct.pack('>III', *group)
+    return data
+
+
+def build_cmap_table(platform_id, encoding_id, glyph_map):
+    """Writes format 4 as (3, 1), which GDI and VSFilter require, or as (3, 0) for symbol fonts,
+    and format 12 as (3, 10) for characters outside the BMP, whatever subtable the source font preferred"""
+    symbol = (platform_id, encoding_id) == (3, 0)
+    subtables = []
+    format_4 = build_format_4_subtable(glyph_map)
+    if format_4 is not None:
+        subtables.append(((3, 0) if symbol else (3, 1), format_4))
+    if not symbol and (format_4 is None or max(glyph_map, default=0) > 0xFFFF):
+        subtables.append(((3, 10), build_format_12_subtable(glyph_map)))
+
+    data = struct.pack('>HH', 0, len(subtables))
+    offset = 4 + len(subtables) * 8
+    for (platform_id, encoding_id), subtable in subtables:
+        data += struct.pack('>HHI', platform_id, encoding_id, offset)
+        offset += len(subtable)
+    return data + b''.join(x[1] for x in subtables)
+
+
+def get_check_sum(data):
+    data = bytes(data) + b'\0' * (-len(data) % 4)
+    values = array('I', data)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return sum(values) & 0xFFFFFFFF
+
+
+def build_font(version, tables):
+    """Assembles tables (dict tag -> bytes) into a font file and fixes up all checksums"""
+    tags = sorted(tables.keys())
+    entry_selector = len(tags).bit_length() - 1
+    search_range = 2 ** entry_selector * 16
+    header = struct.pack('>IHHHH', version, len(tags), search_range, entry_selector, len(tags) * 16 - search_range)
+
+    if b'head' in tables:
+        head = bytearray(tables[b'head'])
+        struct.pack_into('>I', head, 8, 0)
+        tables[b'head'] = head
+
+    directory = b''
+    body = bytearray()
+    offset = len(header) + len(tags) * 16
+    head_offset = None
+    for tag in tags:
+        data = tables[tag]
+        if tag == b'head':
+            head_offset = offset + len(body)
+        directory += struct.pack('>4sLLL', tag, get_check_sum(data), offset + len(body), len(data))
+        body += data
+        body += b'\0' * (-len(data) % 4)
+
+    font = bytearray(header + directory + body)
+    if head_offset is not None:
+        struct.pack_into('>I', font, head_offset + 8, (0xB1B0AFBA - get_check_sum(font)) & 0xFFFFFFFF)
+    return font
+
+
+def subset_font(data, offset, chars):
+    """Returns font at offset as a standalone font file with outlines only for chars.
+    Glyph ids are kept so layout tables stay valid, outlines of glyphs that aren't needed are emptied.
+    Glyphs not reachable through cmap (ligatures, alternates) are kept since layout tables may substitute them.
+    Fonts without glyf outlines are only extracted"""
+    version, directory = read_table_directory(data, offset)
+    tables = {tag: data[start:start + length] for tag, (start, length) in directory.items() if tag not in dropped_tables}
+    if not {b'glyf', b'loca', b'head', b'maxp', b'cmap'}.issubset(tables.keys()):
+        return build_font(version, tables)
+
+    glyph_map = get_glyph_map(data, directory[b'cmap'][0])
+    if glyph_map is None:
+        return build_font(version, tables)
+    platform_id, encoding_id, all_glyphs = glyph_map
+
+    num_glyphs = struct.unpack_from('>H', tables[b'maxp'], 4)[0]
+    long_loca = struct.unpack_from('>h', tables[b'head'], 50)[0] == 1
+    if long_loca:
+        loca = struct.unpack_from('>%iI' % (num_glyphs + 1), tables[b'loca'])
+    else:
+        loca = [x * 2 for x in struct.unpack_from('>%iH' % (num_glyphs + 1), tables[b'loca'])]
+    glyf = tables[b'glyf']
+
+    codes = get_used_codes(chars, platform_id, encoding_id)
+    glyph_map = {code: glyph for code, glyph in all_glyphs.items() if code in codes and glyph < num_glyphs}
+    kept = {0} | set(glyph_map.values()) | (set(range(num_glyphs)) - set(all_glyphs.values()))
+
+    pending = list(kept)
+    while pending:
+        glyph = pending.pop()
+        if glyph >= num_glyphs:
+            continue
+        for component in get_glyph_components(glyf[loca[glyph]:loca[glyph + 1]]):
+            if component not in kept:
+                kept.add(component)
+                pending.append(component)
+
+    new_glyf = bytearray()
+    new_loca = [0]
+    for glyph in range(num_glyphs):
+        if glyph in kept:
+            new_glyf += glyf[loca[glyph]:loca[glyph + 1]]
+            new_glyf += b'\0' * (len(new_glyf) % 2)
+        new_loca.append(len(new_glyf))
+    tables[b'glyf'] = new_glyf
+    if long_loca:
+        tables[b'loca'] = struct.pack('>%iI' % len(new_loca), *new_loca)
+    else:
+        tables[b'loca'] = struct.pack('>%iH' % len(new_loca), *(x // 2 for x in new_loca))
+
+    tables[b'cmap'] = build_cmap_table(platform_id, encoding_id, glyph_map)
+
+    if b'hhea' in tables and b'hmtx' in tables:
+        #glyphs past the last kept one only need a side bearing, their advance is never used
+        metrics_count = struct.unpack_from('>H', tables[b'hhea'], 34)[0]
+        new_count = min(metrics_count, max(kept) + 1)
+        hmtx = tables[b'hmtx']
+        bearings = bytearray((num_glyphs - new_count) * 2)
+        for glyph in range(new_count, num_glyphs):
+            if glyph in kept:
+                pos = glyph * 4 + 2 if glyph < metrics_count else metrics_count * 4 + (glyph - metrics_count) * 2
+                bearings[(glyph - new_count) * 2:(glyph - new_count + 1) * 2] = hmtx[pos:pos + 2]
+        tables[b'hmtx'] = hmtx[:new_count * 4] + bearings
+        hhea = bytearray(tables[b'hhea'])
+        struct.pack_into('>H', hhea, 34, new_count)
+        tables[b'hhea'] = hhea
+
+    return build_font(version, tables)
+
+
+def get_subset_file_name(info, index):
+    name, extension = os.path.splitext(os.path.basename(info.path))
+    if index is not None:
+        return '%s_%i.ttf' % (name, index)
+    return name + extension
+
+
+def write_subset_font(info, chars, folder):
+    """Writes font described by info reduced to chars into folder. Returns path of the new file"""
+    with map_font_file(info.path) as data:
+        index, offset = find_font(data, info)
+        path = os.path.join(folder, get_subset_file_name(info, index))
+        if index is None and b'glyf' not in read_table_directory(data, 0)[1]:
+            #nothing to gain by rewriting, CFF outlines are not subsetted
+            shutil.copy2(info.path, path)
+            return path
+        font = subset_font(data, offset, chars)
+    with open(path, 'wb') as file:
+        file.write(font)
+    return path
@@ -1,7 +1,7 @@
 from collections import namedtuple
 import logging
 import struct
-from font_loader.ttf_parser import TTFFont
+from font_loader.ttf_parser import TTFFont, map_font_file
 
 TTCHeader = namedtuple('TTCHeader', ['tag','version','num_fonts'])
 
@@ -12,19 +12,18 @@ class TTCFont(object):
         self.parse(path)
 
     def parse(self, path):
-        with open(path,'rb') as file:
-            data = struct.unpack('>4sIL', file.read(12))
-            ttc_header = TTCHeader(data[0].decode('ascii'),data[1],data[2])
+        #all subfonts share the same mapping
+        with map_font_file(path) as data:
+            tag, version, num_fonts = struct.unpack_from('>4sIL', data, 0)
+            ttc_header = TTCHeader(tag.decode('ascii'), version, num_fonts)
             if ttc_header.tag != 'ttcf':
                 return
 
-            ttf_offsets = []
-            for i in range(ttc_header.num_fonts):
-                ttf_offsets.append(struct.unpack('>I',file.read(4))[0])
+            ttf_offsets = struct.unpack_from('>%iI' % ttc_header.num_fonts, data, 12)
 
-        for offset in ttf_offsets:
-            ttf_font = TTFFont(path, offset)
-            self.__info.append(ttf_font.get_info())
+            for offset in ttf_offsets:
+                ttf_font = TTFFont(path, offset, data)
+                self.__info.append(ttf_font.get_info())
 
     def get_infos(self):
         return self.__info
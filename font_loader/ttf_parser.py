@@ -1,7 +1,10 @@
 from collections import namedtuple, defaultdict
+from contextlib import contextmanager
 import logging
+import mmap
 import struct
 from font_loader import FontWeight
+from font_loader.cmap_parser import get_coverage
 from font_loader.font_info import FontInfo
 
 OffsetTable = namedtuple('OffsetTable', ['version', 'num_tables', 'search_range', 'entry_selector', 'range_shift'])
@@ -11,6 +14,24 @@ NameRecord = namedtuple('NameRecord', ['platform_id', 'encoding_id', 'language_i
 OS2Table = namedtuple('OS2Table',['version', 'avg_char_width', 'weight_class'])
 
 
+@contextmanager
+def map_font_file(path):
+    """Maps the whole file into memory so all tables can be decoded without any additional reads"""
+    with open(path, 'rb') as file:
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            #empty files can't be mapped
+            data = None
+        if data is None:
+            yield file.read()
+        else:
+            try:
+                yield data
+            finally:
+                data.close()
+
+
 class TTFFont(object):
     platform_id_3_encodings = {
         0:'ISO-8859-1',
@@ -47,54 +68,85 @@ class TTFFont(object):
         WWSFamilyName = 21
         WWSSubfamilyName = 22
 
-    def __init__(self, path, offset=0):
-        self.headers = defaultdict(list)
+    #names get_info and the font matcher need. Everything else is decoded only when headers are requested
+    scan_name_ids = frozenset({TTFNameId.FontFamilyName, TTFNameId.FontSubFamilyName, TTFNameId.FullFontName,
+                               TTFNameId.PreferredFamily, TTFNameId.PreferredSubfamily})
+
+    def __init__(self, path, offset=0, data=None, fast_scan=True, keep_names=False):
+        """With fast_scan, names that aren't needed for matching are decoded from the file when headers are requested.
+        keep_names keeps a copy of the name table for that instead, for data that doesn't come from an openable path"""
+        self.__headers = defaultdict(list)
+        self.__headers_complete = not fast_scan
+        self.__keep_names = keep_names
+        self.__name_table_offset = None
+        self.__name_table = None
         self.__bold = False
         self.__italic = False
         self.__weight = FontWeight.FW_UNDEFINED
         self.__names = set()
+        self.__coverage = None
         self.__path = path
-        self.parse(self.__path, offset)
-
-    def parse(self, path, offset):
-        with open(path,'rb') as file:
-            file.seek(offset)
-            data = struct.unpack('>IHHHH', file.read(12))
-            offset_table = OffsetTable._make(data)
-            pos = file.tell()
-
-            for i in range(offset_table.num_tables):
-                file.seek(pos)
-                data = struct.unpack('>4sLLL', file.read(16))
-                table_directory = TableDirectory(data[0].decode('utf-8'), data[1], data[2], data[3])
-                pos = file.tell()
-
-                if table_directory.tag == 'name':
-                    self.__parse_name_table(file,table_directory.offset)
-
-                if table_directory.tag == 'OS/2':
-                    self.__parse_os2_table(file,table_directory.offset)
-
-    def __parse_os2_table(self,file,offset):
-        file.seek(offset)
-        data = struct.unpack('>HhH',file.read(6))
-        os2_table = OS2Table(data[0],data[1],data[2])
+        if data is None:
+            with map_font_file(path) as data:
+                self.parse(data, offset)
+        else:
+            self.parse(data, offset)
+
+    @property
+    def headers(self):
+        if not self.__headers_complete:
+            self.__headers = defaultdict(list)
+            if self.__name_table is not None:
+                self.__parse_name_table(self.__name_table, 0, None)
+            elif self.__name_table_offset is not None:
+                with map_font_file(self.__path) as data:
+                    self.__parse_name_table(data, self.__name_table_offset, None)
+            self.__headers_complete = True
+        return self.__headers
+
+    def parse(self, data, offset):
+        offset_table = OffsetTable._make(struct.unpack_from('>IHHHH', data, offset))
+        pos = offset + 12
+
+        for i in range(offset_table.num_tables):
+            tag, check_sum, table_offset, length = struct.unpack_from('>4sLLL', data, pos)
+            table_directory = TableDirectory(tag.decode('utf-8'), check_sum, table_offset, length)
+            pos += 16
+
+            if table_directory.tag == 'name':
+                self.__name_table_offset = table_directory.offset
+                if self.__keep_names and not self.__headers_complete:
+                    self.__name_table = bytes(data[table_directory.offset:table_directory.offset + table_directory.length])
+                self.__parse_name_table(data, table_directory.offset, None if self.__headers_complete else self.scan_name_ids)
+
+            if table_directory.tag == 'OS/2':
+                self.__parse_os2_table(data, table_directory.offset)
+
+            if table_directory.tag == 'cmap':
+                self.__parse_cmap_table(data, table_directory.offset)
+
+    def __parse_cmap_table(self, data, offset):
+        try:
+            self.__coverage = get_coverage(data, offset)
+        except struct.error as e:
+            logging.debug("Couldn't parse cmap table of font file %s: %s" % (self.__path, e))
+
+    def __parse_os2_table(self, data, offset):
+        os2_table = OS2Table._make(struct.unpack_from('>HhH', data, offset))
         self.__weight = os2_table.weight_class
 
-    def __parse_name_table(self,file,offset):
-        file.seek(offset)
-        data = struct.unpack('>HHH', file.read(6))
-        naming_table = NamingTable._make(data)
+    def __parse_name_table(self, data, offset, name_ids):
+        naming_table = NamingTable._make(struct.unpack_from('>HHH', data, offset))
+        storage = offset + naming_table.offset_start_of_string_storage
 
-        names = []
-        for record in range(naming_table.number_of_name_records):
-            data = struct.unpack('>HHHHHH', file.read(12))
-            names.append(NameRecord._make(data))
-
-        for name in names:
-            file.seek(offset + naming_table.offset_start_of_string_storage + name.offset_from_storage_area)
-            size = int(name.string_length)
-            string = file.read(size)
+        #the whole record array is unpacked at once, 6 values per record
+        records = struct.unpack_from('>%iH' % (naming_table.number_of_name_records * 6), data, offset + 6)
+        for index in range(0, len(records), 6):
+            if name_ids is not None and records[index + 3] not in name_ids:
+                continue
+            name = NameRecord._make(records[index:index + 6])
+            start = storage + name.offset_from_storage_area
+            string = data[start:start + name.string_length]
             if name.platform_id == 3:
                 value = self.__decode_string(string,self.platform_id_3_encodings[name.encoding_id])
 
@@ -117,7 +169,7 @@ class TTFFont(object):
         return
 
     def __decode_string(self,bytes,encoding):
-        return struct.unpack('>' + str(len(bytes))+'s', bytes)[0].decode(encoding)
+        return bytes.decode(encoding)
 
     def __set_name_by_id(self, id, value):
         if id is self.TTFNameId.FontFamilyName or id is self.TTFNameId.FullFontName:
@@ -125,7 +177,7 @@ class TTFFont(object):
         elif id is self.TTFNameId.FontSubFamilyName:
             self.__parse_styles(value)
 
-        self.headers[id].append(value)
+        self.__headers[id].append(value)
 
     def __parse_styles(self, sub_family_name):
         name = sub_family_name.lower()
@@ -140,5 +192,5 @@ class TTFFont(object):
             print(str(types[id]).ljust(25), value)
 
     def get_info(self):
-        return FontInfo(list(self.__names), self.__bold, self.__italic, self.__weight, self.__path, None)
+        return FontInfo(list(self.__names), self.__bold, self.__italic, self.__weight, self.__path, None, self.__coverage)
 
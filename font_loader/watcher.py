@@ -0,0 +1,215 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from font_loader import is_supported_font
+from font_loader.font_cache import get_file_stat
+from misc import list_directory
+
+Event = struct.Struct('iIII')
+
+
+class InotifyWaiter(object):
+    """Wakes the watcher up as soon as anything changes in the watched directories. Linux only"""
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    #copying a font produces a burst of events, wait for it to settle before rescanning
+    settle_time = 0.5
+
+    def __init__(self):
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        #watch descriptor -> directory
+        self.__directories = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, directories):
+        #adding an already watched directory only updates its mask, so this is safe to repeat after every poll
+        for directory in directories:
+            descriptor = self.__libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+            if descriptor >= 0:
+                self.__directories[descriptor] = directory
+
+    def wait(self, timeout):
+        """Returns None if nothing changed before timeout expired. Otherwise returns (directories, trees):
+        directories whose files changed, and subdirectories created, deleted or moved as a whole.
+        Both are None if events were lost and everything has to be rescanned"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        time.sleep(self.settle_time)
+        directories = set()
+        trees = set()
+        for descriptor, mask, name in self.__read_events():
+            if mask & self.IN_Q_OVERFLOW:
+                return None, None
+            directory = self.__directories.get(descriptor)
+            if mask & self.IN_IGNORED:
+                self.__directories.pop(descriptor, None)
+            elif directory is None:
+                continue
+            elif mask & self.IN_ISDIR:
+                trees.add(os.path.join(directory, name))
+            else:
+                directories.add(directory)
+        return directories, trees
+
+    def __read_events(self):
+        data = b''
+        try:
+            while True:
+                chunk = os.read(self.fd, 65536)
+                if not chunk:
+                    break
+                data += chunk
+        except BlockingIOError:
+            pass
+        pos = 0
+        while pos + Event.size <= len(data):
+            descriptor, mask, cookie, length = Event.unpack_from(data, pos)
+            pos += Event.size
+            yield descriptor, mask, os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+
+
+class FontWatcher(object):
+    """Polls font directories of a FontLoader and applies added, removed and modified fonts to it in the background.
+    With inotify, directories are rescanned as soon as they change, and everything is polled every full_poll_interval
+    seconds for changes inotify doesn't report, like the ones other clients make on network file systems"""
+
+    def __init__(self, loader, interval = 5.0, full_poll_interval = 60.0):
+        self.loader = loader
+        self.interval = interval
+        self.full_poll_interval = full_poll_interval
+        self.__snapshot = None
+        #every directory of the walked trees, so fonts added to directories without fonts are noticed too
+        self.__directories = set()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.__waiter = None
+        if sys.platform.startswith('linux'):
+            try:
+                self.__waiter = InotifyWaiter()
+            except (OSError, AttributeError) as e:
+                logging.debug('inotify is not available (%s), only polling font directories' % e)
+
+    def get_roots(self):
+        roots = [os.path.normpath(x) for x in self.loader.font_dirs or []]
+        if self.loader.load_system_fonts and sys.platform != 'win32':
+            roots.extend(os.path.normpath(x) for x in self.loader.get_system_font_directories())
+        return roots
+
+    @staticmethod
+    def walk(roots):
+        """Returns (font files, directories) of the directory trees"""
+        files = []
+        directories = set()
+        pending = list(roots)
+        while pending:
+            directory = pending.pop()
+            if directory in directories or not os.path.isdir(directory):
+                continue
+            directories.add(directory)
+            found, subdirs, elapsed = list_directory(directory, is_supported_font)
+            files.extend(found)
+            pending.extend(subdirs)
+        return files, directories
+
+    @staticmethod
+    def stat_files(paths, snapshot):
+        for path in paths:
+            try:
+                snapshot[path] = get_file_stat(path)
+            except OSError:
+                pass
+        return snapshot
+
+    def take_snapshot(self):
+        """Returns dict path -> stat of all font files of the loader"""
+        files, self.__directories = self.walk(self.get_roots())
+        if self.loader.load_system_fonts and sys.platform == 'win32':
+            #system fonts are registered in the registry rather than found by walking directories
+            files.extend(self.loader.enumerate_windows_system_fonts())
+        return self.stat_files(files, {})
+
+    def update_snapshot(self, directories, trees):
+        """Returns the previous snapshot with only files of the given directories and directory trees stat'ed again"""
+        in_trees = lambda path: any(path == x or path.startswith(x + os.sep) for x in trees)
+        snapshot = {path: stat for path, stat in self.__snapshot.items()
+                    if os.path.dirname(path) not in directories and not in_trees(path)}
+        self.__directories = set(x for x in self.__directories if not in_trees(x))
+        paths = []
+        for directory in directories:
+            paths.extend(list_directory(directory, is_supported_font)[0])
+        files, walked = self.walk(trees)
+        paths.extend(files)
+        self.__directories.update(walked)
+        return self.stat_files(paths, snapshot)
+
+    def poll(self, directories = None, trees = None):
+        """Applies changes made since the previous poll to the loader. Returns the number of changed files.
+        With directories or trees, only those are rescanned, otherwise all font directories are"""
+        if self.__snapshot is None or (directories is None and trees is None):
+            snapshot = self.take_snapshot()
+        else:
+            snapshot = self.update_snapshot(directories or set(), trees or set())
+        if snapshot == self.__snapshot:
+            return 0
+        self.__snapshot = snapshot
+        changed = self.loader.reload(set(snapshot.keys()), snapshot)
+        if changed:
+            logging.info('Font cache updated, %i files changed' % changed)
+        return changed
+
+    def run(self):
+        """Polls until stop is called. With inotify, only directories reported as changed are rescanned in between full polls"""
+        changes = None, None
+        last_full_poll = 0.0
+        while not self.__stopped.is_set():
+            if changes is not None:
+                if changes == (None, None):
+                    last_full_poll = time.monotonic()
+                try:
+                    self.poll(*changes)
+                except Exception:
+                    logging.exception('Failed to update fonts')
+            changes = self.__wait()
+            if changes is None and time.monotonic() - last_full_poll >= self.full_poll_interval:
+                changes = None, None
+
+    def __wait(self):
+        """Returns what changed like InotifyWaiter.wait, (None, None) when polling without inotify"""
+        if self.__waiter is None:
+            self.__stopped.wait(self.interval)
+            return None, None
+        self.__waiter.watch(sorted(self.__directories))
+        return self.__waiter.wait(self.interval)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.run, name='FontWatcher', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        if self.__waiter is not None:
+            self.__waiter.close()
@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from ass_parser import AssParser, StyleInfo, UsageData
+from font_loader.font_info import FontInfo
+from misc import get_app_data_folder
+
+
+class FontServerError(Exception):
+    pass
+
+
+def get_default_socket_path():
+    return os.path.join(get_app_data_folder(), 'assfc.sock')
+
+def get_loader_signature(font_dirs, load_system_fonts):
+    """Identifies the font set a loader was built for, so clients don't get results for different font dirs"""
+    return {'font_dirs': sorted(set(os.path.abspath(x) for x in font_dirs or [])),
+            'include_system_fonts': bool(load_system_fonts)}
+
+def style_to_json(style):
+    return [style.fontname, style.bold, style.italic]
+
+def font_to_json(font):
+    return {'names': font.names, 'bold': font.bold, 'italic': font.italic, 'weight': font.weight, 'path': font.path}
+
+def font_from_json(data):
+    return FontInfo(data['names'], data['bold'], data['italic'], data['weight'], data['path'], None)
+
+
+class FontRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = {}
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = self.server.handle_command(request)
+        except Exception as e:
+            logging.exception('Failed to process request')
+            response = {'error': '%s: %s' % (type(e).__name__, e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+        #only stop after the client got its answer
+        if request.get('command') == 'shutdown':
+            self.server.shutdown()
+
+
+class FontServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Keeps a FontLoader resident and answers requests, one JSON line per connection"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, loader, font_dirs, load_system_fonts):
+        self.loader = loader
+        self.signature = get_loader_signature(font_dirs, load_system_fonts)
+        self.lock = threading.Lock()
+        if os.path.exists(socket_path):
+            if FontClient(socket_path).is_running():
+                raise FontServerError('Another server is already listening on %s' % socket_path)
+            #left over from a server that wasn't shut down properly
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, FontRequestHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+    def handle_command(self, request):
+        command = request.get('command')
+        if command == 'ping':
+            return {'signature': self.signature}
+        if command == 'shutdown':
+            return {}
+
+        signature = request.get('signature')
+        if signature is not None and signature != self.signature:
+            raise FontServerError('Server was started for different font directories')
+
+        if command == 'resolve':
+            font_list = {}
+            for style, chars in request['fonts']:
+                usage = UsageData()
+                usage.chars.update(chars)
+                font_list[StyleInfo(*style)] = usage
+            return self.resolve(font_list)
+        if command == 'collect':
+            try:
+                font_list = AssParser.get_fonts_statistics(request['script'], request.get('exclude_unused_fonts', False),
+                                                           request.get('exclude_comments', False))
+            except SystemExit:
+                raise FontServerError('Failed to parse script %s' % request['script'])
+            return self.resolve(font_list)
+        raise FontServerError('Unknown command %s' % command)
+
+    def resolve(self, font_list):
+        with self.lock:
+            found, not_found = self.loader.get_fonts_for_list(font_list)
+            missing_glyphs = self.loader.missing_glyphs
+            resolved = self.loader.resolved
+        return {'found': [[style_to_json(style), font_to_json(font)] for style, font in found.items()],
+                'resolved': [[style_to_json(style), font_to_json(font)] for style, font in resolved.items()],
+                'missing_glyphs': [[style_to_json(style), ''.join(sorted(chars))] for style, chars in missing_glyphs.items()],
+                'not_found': [{'font': style_to_json(style), 'styles': sorted(usage.styles), 'lines': sorted(usage.lines)}
+                              for style, usage in not_found.items()]}
+
+
+class FontClient(object):
+    """Forwards font lookups to a running FontServer. Can be used in place of FontLoader"""
+
+    def __init__(self, socket_path, font_dirs = None, load_system_fonts = True, timeout = None, ping_timeout = 1.0):
+        """timeout applies to lookups, which can wait for the server reloading fonts.
+        ping_timeout keeps a hung server from blocking the check whether it can be used"""
+        self.socket_path = socket_path
+        self.signature = get_loader_signature(font_dirs, load_system_fonts)
+        self.timeout = timeout
+        self.ping_timeout = ping_timeout
+        self.missing_glyphs = {}
+        self.resolved = {}
+
+    def request(self, data, timeout = None):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.timeout if timeout is None else timeout)
+            connection.connect(self.socket_path)
+            connection.sendall((json.dumps(data) + '\n').encode('utf-8'))
+            with connection.makefile('rb') as file:
+                response = json.loads(file.readline().decode('utf-8'))
+        if 'error' in response:
+            raise FontServerError(response['error'])
+        return response
+
+    def is_running(self):
+        try:
+            self.request({'command': 'ping'}, self.ping_timeout)
+            return True
+        except (OSError, ValueError, FontServerError):
+            return False
+
+    def is_compatible(self):
+        """True if the server is running and was started for the same font set"""
+        try:
+            return self.request({'command': 'ping'}, self.ping_timeout)['signature'] == self.signature
+        except (OSError, ValueError, FontServerError):
+            return False
+
+    def shutdown(self):
+        self.request({'command': 'shutdown'})
+
+    def get_fonts_for_list(self, font_list):
+        response = self.request({'command': 'resolve', 'signature': self.signature,
+                                 'fonts': [[style_to_json(x), ''.join(usage.chars)] for x, usage in font_list.items()]})
+        found = {StyleInfo(*style): font_from_json(font) for style, font in response['found']}
+        self.missing_glyphs = {StyleInfo(*style): set(chars) for style, chars in response['missing_glyphs']}
+        self.resolved = {StyleInfo(*style): font_from_json(font) for style, font in response['resolved']}
+        #styles sharing a font with another style are left out of found without being missing
+        not_found = {}
+        for item in response['not_found']:
+            style = StyleInfo(*item['font'])
+            not_found[style] = font_list[style]
+        return found, not_found
+
+    def collect(self, script, exclude_unused_fonts = False, exclude_comments = False):
+        """Lets the server parse the script. Returns (found, not_found) like FontLoader.get_fonts_for_list"""
+        response = self.request({'command': 'collect', 'signature': self.signature, 'script': os.path.abspath(script),
+                                 'exclude_unused_fonts': exclude_unused_fonts, 'exclude_comments': exclude_comments})
+        found = {StyleInfo(*style): font_from_json(font) for style, font in response['found']}
+        self.missing_glyphs = {StyleInfo(*style): set(chars) for style, chars in response['missing_glyphs']}
+        self.resolved = {StyleInfo(*style): font_from_json(font) for style, font in response['resolved']}
+        not_found = {}
+        for item in response['not_found']:
+            usage = UsageData()
+            usage.styles.update(item['styles'])
+            usage.lines.update(item['lines'])
+            not_found[StyleInfo(*item['font'])] = usage
+        return found, not_found
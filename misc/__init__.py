@@ -1,10 +1,10 @@
-import hashlib
 import logging
 import os
 import sys
-from re import compile
+from time import time
 
 def calculate_md5_for_file(path, block_size=2**20):
+    import hashlib
     md5 = hashlib.md5()
     with open(path, 'rb') as file:
         while True:
@@ -14,19 +14,115 @@ def calculate_md5_for_file(path, block_size=2**20):
             md5.update(data)
     return md5.hexdigest()
 
-def enumerate_files_in_directory(directory):
+def calculate_partial_md5_for_file(path, block_size=2**16):
+    """Hashes size, head and tail of the file. Cheap way to tell apart files of the same size"""
+    import hashlib
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        md5.update(str(size).encode('ascii'))
+        md5.update(file.read(block_size))
+        if size > block_size * 2:
+            file.seek(-block_size, os.SEEK_END)
+        md5.update(file.read(block_size))
+    return md5.hexdigest()
+
+def create_process_pool(workers):
+    """ProcessPoolExecutor that can be started while other threads run. Forked workers inherit locks
+    (logging, sqlite) held by the other threads at the time and can deadlock on them, so workers are started fresh"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method))
+
+def enumerate_files_in_directory(directory, predicate = None, timings = None):
+    """Lists all files in directory tree. predicate filters file paths during the walk, timings receives path -> listing time"""
     logging.debug('Enumerating files in directory %s' % directory)
     files = []
     if sys.platform == 'win32':
         windows_enumerate_directory(directory, files)
+        if predicate:
+            files = [x for x in files if predicate(x)]
     else:
-        linux_enumerate_directory(directory, files)
+        files = scandir_enumerate_directory(directory, predicate, timings=timings)
     return files
 
-def linux_enumerate_directory(directory, files_collection):
-    for path, subdirs, files in os.walk(directory):
-        for name in files:
-            files_collection.append(os.path.join(path, name))
+def list_directory(directory, predicate):
+    start = time()
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        #like os.walk, symlinks to directories are not followed
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif predicate is None or predicate(entry.path):
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError as e:
+        logging.debug("Couldn't list directory %s: %s" % (directory, e))
+    return files, subdirs, time() - start
+
+def scandir_enumerate_directory(directory, predicate = None, workers = 16, timings = None):
+    """Walks directory tree listing every directory in a thread pool, which pays off on high-latency filesystems"""
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    files = []
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(list_directory, directory, predicate): directory}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                found, subdirs, elapsed = future.result()
+                files.extend(found)
+                if timings is not None:
+                    timings[path] = elapsed
+                for subdir in subdirs:
+                    pending[executor.submit(list_directory, subdir, predicate)] = subdir
+    return files
+
+def list_directory_with_manifest(directory, predicate, entry):
+    """Returns (entry, unchanged, elapsed), entry is None if directory can't be opened"""
+    start = time()
+    try:
+        #taken before listing, so changes made while listing make the next walk list it again
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError as e:
+        logging.debug("Couldn't open directory %s: %s" % (directory, e))
+        return None, None, time() - start
+    if entry is not None and entry[0] == mtime:
+        return entry, True, time() - start
+    files, subdirs, elapsed = list_directory(directory, predicate)
+    return (mtime, files, subdirs), False, time() - start
+
+def manifest_enumerate_directory(directory, predicate, manifest, workers = 16, timings = None):
+    """Walks directory tree, listing only directories whose mtime differs from the one in manifest (path -> (mtime, files, subdirs)).
+    Returns (files, entries) where entries is dict path -> ((mtime, files, subdirs), unchanged) of all visited directories.
+    timings receives path -> time spent checking or listing it"""
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    files = []
+    entries = {}
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(list_directory_with_manifest, directory, predicate, manifest.get(directory)): directory}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                entry, unchanged, elapsed = future.result()
+                if timings is not None:
+                    timings[path] = elapsed
+                if entry is None:
+                    continue
+                entries[path] = (entry, unchanged)
+                files.extend(entry[1])
+                for subdir in entry[2]:
+                    if subdir not in entries:
+                        pending[executor.submit(list_directory_with_manifest, subdir, predicate, manifest.get(subdir))] = subdir
+    return files, entries
 
 def windows_enumerate_directory(directory, files):
     from ctypes import windll, wintypes, byref
@@ -59,15 +155,22 @@ def windows_enumerate_directory(directory, files):
 
 
 APPNAME = "assfc"
+#folders known to exist, so they are checked only once per process
+existing_app_data_folders = set()
 
 def get_app_data_folder():
-    if sys.platform == 'win32':
+    #lets benchmarks and separate setups keep their own cache
+    if os.environ.get('ASSFC_DATA_DIR'):
+        appdata = os.environ['ASSFC_DATA_DIR']
+    elif sys.platform == 'win32':
         appdata = os.path.join(os.environ['APPDATA'], APPNAME)
     elif sys.platform == 'darwin':
         appdata = os.path.join(os.path.expanduser('~'),'Library/Application Support', APPNAME)
     else:
         appdata = os.path.expanduser(os.path.join("~", "." + APPNAME))
 
-    if not os.path.exists(appdata):
-        os.mkdir(appdata)
+    if appdata not in existing_app_data_folders:
+        if not os.path.exists(appdata):
+            os.mkdir(appdata)
+        existing_app_data_folders.add(appdata)
     return appdata
\ No newline at end of file
@@ -0,0 +1,86 @@
+from collections import Counter
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from misc import calculate_md5_for_file
+
+#ioctl cloning a whole file on copy-on-write file systems (btrfs, xfs, bcachefs)
+FICLONE = 0x40049409
+
+
+def are_files_identical(source, dest):
+    """True if dest exists and has the same content as source"""
+    try:
+        source_stat = os.stat(source)
+        dest_stat = os.stat(dest)
+    except OSError:
+        return False
+    if (source_stat.st_dev, source_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino):
+        return True
+    if source_stat.st_size != dest_stat.st_size:
+        return False
+    return calculate_md5_for_file(source) == calculate_md5_for_file(dest)
+
+
+def clone_file(source, dest):
+    """Copies source sharing its blocks, or at least inside the kernel. Returns False if the file system can't do it"""
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    with open(source, 'rb') as source_file, open(dest, 'wb') as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            if not hasattr(os, 'copy_file_range'):
+                return False
+            try:
+                while os.copy_file_range(source_file.fileno(), dest_file.fileno(), 2**30):
+                    pass
+            except OSError:
+                return False
+    shutil.copystat(source, dest)
+    return True
+
+
+def copy_file(source, dest, mode = 'clone'):
+    """Copies source to dest unless dest already has the same content. Returns what was done:
+    'skipped', 'linked', 'cloned' or 'copied'. Modes that aren't possible for the pair fall back to a plain copy.
+    The file is written next to dest and moved over it, so a dest hard linked by an earlier run is replaced
+    rather than written through, which would change the linked original"""
+    if are_files_identical(source, dest):
+        return 'skipped'
+    handle, temp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(dest), suffix='.tmp', dir=os.path.dirname(dest) or '.')
+    os.close(handle)
+    try:
+        result = write_file(source, temp_path, mode)
+        os.replace(temp_path, dest)
+        return result
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_file(source, dest, mode):
+    if mode == 'hardlink':
+        try:
+            os.remove(dest)
+            os.link(source, dest)
+            return 'linked'
+        except OSError as e:
+            logging.debug("Couldn't link %s, copying it: %s" % (source, e))
+    elif mode == 'clone' and clone_file(source, dest):
+        return 'cloned'
+    shutil.copy2(source, dest)
+    return 'copied'
+
+
+def copy_files(pairs, mode = 'clone', workers = 8):
+    """Copies list of (source, dest) pairs in parallel. Returns Counter of copy_file results"""
+    if len(pairs) < 2 or workers < 2:
+        return Counter(copy_file(source, dest, mode) for source, dest in pairs)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(min(workers, len(pairs))) as executor:
+        return Counter(executor.map(lambda x: copy_file(x[0], x[1], mode), pairs))
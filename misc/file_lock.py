@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+import logging
+import sys
+from time import perf_counter
+
+
+def try_lock(file, exclusive, blocking):
+    """Returns False if the lock is held by someone else and blocking is off"""
+    if sys.platform == 'win32':
+        import msvcrt
+        #windows has no shared locks, readers exclude each other there
+        file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                #LK_LOCK gives up after 10 seconds, so keep polling instead
+                from time import sleep
+                sleep(0.05)
+    import fcntl
+    try:
+        fcntl.flock(file.fileno(), (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+
+@contextmanager
+def locked(path, exclusive = True, message = None):
+    """Holds an advisory lock on path (created if missing) while in the block. Shared locks only exclude exclusive ones.
+    message is logged when the lock is held by another process and has to be waited for"""
+    file = open(path, 'a+b')
+    try:
+        if not try_lock(file, exclusive, False):
+            if message:
+                logging.info(message)
+            start = perf_counter()
+            try_lock(file, exclusive, True)
+            logging.debug('Waited %.3fs for lock %s' % (perf_counter() - start, path))
+        yield
+    finally:
+        #closing the file releases the lock
+        file.close()
@@ -0,0 +1,170 @@
+import os
+import random
+import struct
+
+#element ids of the Matroska subset written here
+EBML = 0x1A45DFA3
+EBMLVersion = 0x4286
+EBMLReadVersion = 0x42F7
+EBMLMaxIDLength = 0x42F2
+EBMLMaxSizeLength = 0x42F3
+DocType = 0x4282
+DocTypeVersion = 0x4287
+DocTypeReadVersion = 0x4285
+Segment = 0x18538067
+Info = 0x1549A966
+TimestampScale = 0x2AD7B1
+Duration = 0x4489
+MuxingApp = 0x4D80
+WritingApp = 0x5741
+Tracks = 0x1654AE6B
+TrackEntry = 0xAE
+TrackNumber = 0xD7
+TrackUID = 0x73C5
+TrackType = 0x83
+FlagLacing = 0x9C
+CodecID = 0x86
+CodecPrivate = 0x63A2
+Language = 0x22B59C
+Attachments = 0x1941A469
+AttachedFile = 0x61A7
+FileName = 0x466E
+FileMediaType = 0x4660
+FileData = 0x465C
+FileUID = 0x46AE
+Cluster = 0x1F43B675
+Timestamp = 0xE7
+BlockGroup = 0xA0
+Block = 0xA1
+BlockDuration = 0x9B
+
+TRACK_TYPE_SUBTITLE = 0x11
+#block timestamps are signed 16 bit offsets from the cluster timestamp
+MAX_CLUSTER_OFFSET = 0x7FFF
+FONT_MEDIA_TYPE = 'application/x-truetype-font'
+
+
+def encode_id(id):
+    return id.to_bytes((id.bit_length() + 7) // 8, 'big')
+
+def encode_size(size):
+    length = 1
+    #all ones is reserved for unknown size
+    while size >= (1 << (7 * length)) - 1:
+        length += 1
+    return (size | (1 << (7 * length))).to_bytes(length, 'big')
+
+def element(id, data):
+    return encode_id(id) + encode_size(len(data)) + data
+
+def uint_element(id, value):
+    return element(id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+def float_element(id, value):
+    return element(id, struct.pack('>d', value))
+
+def string_element(id, value):
+    return element(id, value.encode('utf-8'))
+
+def element_header(id, size):
+    return encode_id(id) + encode_size(size)
+
+def get_uid():
+    return random.getrandbits(63) or 1
+
+
+def parse_ass_time(value):
+    """H:MM:SS.cc -> milliseconds"""
+    hours, minutes, seconds = value.strip().split(':')
+    return int(round((int(hours) * 3600 + int(minutes) * 60 + float(seconds)) * 1000))
+
+
+def split_script(path):
+    """Returns (codec private text, list of (start, end, block text)) of an ASS script.
+    Blocks hold the event fields after Start and End, prefixed by the read order as Matroska expects"""
+    header = []
+    events = []
+    section = None
+    with open(path, encoding='utf-8-sig') as file:
+        for line in file:
+            line = line.rstrip('\r\n')
+            stripped = line.strip()
+            if stripped.startswith('[') and stripped.endswith(']'):
+                section = stripped.lower()
+            if section == '[events]' and not stripped.startswith(('[', 'Format:')):
+                if line.startswith('Dialogue:'):
+                    fields = line.split(':', 1)[1].split(',', 9)
+                    text = ','.join([str(len(events))] + [fields[0].strip()] + fields[3:])
+                    events.append((parse_ass_time(fields[1]), parse_ass_time(fields[2]), text))
+                continue
+            header.append(line)
+    return '\r\n'.join(header).strip() + '\r\n', events
+
+
+def build_clusters(events):
+    clusters = []
+    current = None
+    cluster_start = None
+    for start, end, text in sorted(events, key=lambda x: x[0]):
+        if current is None or start - cluster_start > MAX_CLUSTER_OFFSET:
+            current = bytearray(uint_element(Timestamp, start))
+            cluster_start = start
+            clusters.append(current)
+        block = encode_size(1) + struct.pack('>hB', start - cluster_start, 0) + text.encode('utf-8')
+        current += element(BlockGroup, element(Block, block) + uint_element(BlockDuration, max(0, end - start)))
+    return [element(Cluster, bytes(x)) for x in clusters]
+
+
+def copy_file_data(path, file, size):
+    """Copies exactly size bytes, the sizes of the elements are already written"""
+    with open(path, 'rb') as source:
+        while size:
+            data = source.read(min(size, 2**20))
+            if not data:
+                raise IOError('File %s was truncated while muxing' % path)
+            file.write(data)
+            size -= len(data)
+
+
+def write_mks_file(output_path, script_path, font_paths, application = 'assfc'):
+    """Writes a Matroska file with the script as its only track and the fonts as attachments.
+    Font data is streamed from disk, only the subtitle track is held in memory"""
+    codec_private, events = split_script(script_path)
+    duration = max((x[1] for x in events), default=0)
+
+    ebml = element(EBML, uint_element(EBMLVersion, 1) + uint_element(EBMLReadVersion, 1) +
+                   uint_element(EBMLMaxIDLength, 4) + uint_element(EBMLMaxSizeLength, 8) +
+                   string_element(DocType, 'matroska') + uint_element(DocTypeVersion, 2) + uint_element(DocTypeReadVersion, 2))
+    info = element(Info, uint_element(TimestampScale, 1000000) + float_element(Duration, float(duration)) +
+                   string_element(MuxingApp, application) + string_element(WritingApp, application))
+    tracks = element(Tracks, element(TrackEntry, uint_element(TrackNumber, 1) + uint_element(TrackUID, get_uid()) +
+                                     uint_element(TrackType, TRACK_TYPE_SUBTITLE) + uint_element(FlagLacing, 0) +
+                                     string_element(CodecID, 'S_TEXT/ASS') + string_element(CodecPrivate, codec_private) +
+                                     string_element(Language, 'und')))
+
+    #attachments go before the clusters, so players find fonts without seeking
+    attachments = []
+    for path in font_paths:
+        size = os.path.getsize(path)
+        head = string_element(FileName, os.path.basename(path)) + string_element(FileMediaType, FONT_MEDIA_TYPE) + \
+               uint_element(FileUID, get_uid()) + element_header(FileData, size)
+        attachments.append((path, element_header(AttachedFile, len(head) + size) + head, size))
+    attachments_size = sum(len(head) + size for path, head, size in attachments)
+    clusters = build_clusters(events)
+
+    segment_size = len(info) + len(tracks) + sum(len(x) for x in clusters)
+    if attachments:
+        segment_size += len(element_header(Attachments, attachments_size)) + attachments_size
+
+    with open(output_path, 'wb') as file:
+        file.write(ebml)
+        file.write(element_header(Segment, segment_size))
+        file.write(info)
+        file.write(tracks)
+        if attachments:
+            file.write(element_header(Attachments, attachments_size))
+            for path, head, size in attachments:
+                file.write(head)
+                copy_file_data(path, file, size)
+        for cluster in clusters:
+            file.write(cluster)
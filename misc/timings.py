@@ -0,0 +1,65 @@
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+import logging
+import threading
+from time import perf_counter
+
+
+class Timings(object):
+    """Collects wall time and counts of processing stages. Does nothing until enabled"""
+
+    def __init__(self):
+        self.enabled = False
+        #stages of different threads can end at the same time
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.items = defaultdict(dict)
+
+    def reset(self):
+        self.stages.clear()
+        self.items.clear()
+
+    @contextmanager
+    def stage(self, name, count = 1):
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start, count)
+
+    def add(self, name, elapsed, count = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            total, calls, items = self.stages.get(name, (0.0, 0, 0))
+            self.stages[name] = (total + elapsed, calls + 1, items + count)
+
+    def add_item(self, group, key, elapsed):
+        """Records time spent on a single item, like parsing one font file"""
+        if self.enabled:
+            self.items[group][key] = elapsed
+
+    def get_slowest(self, group, count = 10):
+        return sorted(self.items[group].items(), key=lambda x: x[1], reverse=True)[:count]
+
+    def to_json(self, slowest = 10):
+        return {'stages': [{'name': name, 'time': total, 'calls': calls, 'count': items}
+                           for name, (total, calls, items) in self.stages.items()],
+                'slowest': {group: [{'key': key, 'time': elapsed} for key, elapsed in self.get_slowest(group, slowest)]
+                            for group in self.items.keys()}}
+
+    def report(self, slowest = 10):
+        lines = ['Timings:']
+        for name, (total, calls, items) in self.stages.items():
+            lines.append('  %-20s %10.4fs  %6i calls  %8i items' % (name, total, calls, items))
+        for group in self.items.keys():
+            lines.append('Slowest %s:' % group)
+            lines.extend('  %10.4fs  %s' % (elapsed, key) for key, elapsed in self.get_slowest(group, slowest))
+        logging.info('\n'.join(lines))
+
+
+#shared by all modules of the process
+timings = Timings()
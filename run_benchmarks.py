@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline):
+    for name, timings in results.items():
+        line = '%-32s min %10.4fs  median %10.4fs' % (name, timings['min'], timings['median'])
+        if baseline and name in baseline:
+            line += '  %+7.1f%%' % ((timings['median'] / baseline[name]['median'] - 1) * 100)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="ASS font collector benchmarks")
+    parser.add_argument('-o', '--output', dest='output', metavar='file', help='Write results as JSON')
+    parser.add_argument('--compare', dest='compare', metavar='file', help='Show changes against results of an earlier run')
+    parser.add_argument('--fonts', type=int, default=200, help='Number of generated fonts')
+    parser.add_argument('--events', type=int, nargs='+', default=[1000, 20000], help='Event counts of generated scripts')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of every benchmark')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Processes used to scan fonts')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    directory = tempfile.mkdtemp(prefix='assfc-bench')
+    #keeps the user's font cache untouched
+    os.environ['ASSFC_DATA_DIR'] = os.path.join(directory, 'cache')
+    os.mkdir(os.environ['ASSFC_DATA_DIR'])
+    try:
+        from benchmarks import run_benchmarks
+        results = run_benchmarks(directory, args.fonts, args.events, args.repeat, args.workers)
+    finally:
+        shutil.rmtree(directory)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'commit': get_commit(), 'python': sys.version, 'platform': platform.platform(),
+                       'parameters': {'fonts': args.fonts, 'events': args.events, 'repeat': args.repeat, 'workers': args.workers},
+                       'results': results}, file, indent=2)
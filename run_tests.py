@@ -5,6 +5,12 @@ import unittest
 from tests.font_parsing_tests import *
 from tests.ass_parsing_tests import *
 from tests.integration_tests import *
+from tests.server_tests import *
+from tests.watcher_tests import *
+from tests.misc_tests import *
+from tests.benchmark_tests import *
+from tests.startup_tests import *
+from tests.cli_tests import *
 
 if __name__ == '__main__':
     unittest.main(verbosity=0)
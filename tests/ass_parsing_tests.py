@@ -1,7 +1,9 @@
 from collections import defaultdict
 import logging
+import os
+import tempfile
 import unittest
-from ass_parser import AssParser, StyleInfo, UsageData
+from ass_parser import AssParser, StyleInfo, UsageData, EventCache
 from font_loader import FontWeight
 from tests.common import get_file_in_test_directory, disabled_logging
 
@@ -190,6 +192,33 @@ class EventProcessingTests(unittest.TestCase):
         self.assertEqual(len(used_styles), 2)
 
 
+    def test_cached_event_adds_line_and_chars_of_every_occurrence(self):
+        styles = {'style' : StyleInfo('Font', 0, False)}
+        used_styles = defaultdict(UsageData)
+        cache = EventCache()
+        AssParser.process_event(AssParser.AssEvent(1, 'style', r'{\i1}ab', False), used_styles, styles, cache)
+        AssParser.process_event(AssParser.AssEvent(2, 'style', r'{\i1}ab', False), used_styles, styles, cache)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual({1, 2}, used_styles[StyleInfo('Font', 0, True)].lines)
+        self.assertEqual({'a', 'b'}, used_styles[StyleInfo('Font', 0, True)].chars)
+
+class EventCacheTests(unittest.TestCase):
+    def test_counts_hits_and_misses(self):
+        cache = EventCache()
+        self.assertIsNone(cache.get('a'))
+        cache.add('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_evicts_least_recently_used_items(self):
+        cache = EventCache(2)
+        cache.add('a', 1)
+        cache.add('b', 2)
+        cache.get('a')
+        cache.add('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
 
 class AssParsingTests(unittest.TestCase):
     def test_returns_correct_number_of_all_fonts_in_bakemono_script(self):
@@ -229,5 +258,29 @@ class AssParsingTests(unittest.TestCase):
             styles.update(info.styles)
         self.assertIn('EDromajiEng', styles)
 
-
-
+    def test_iterates_styles_and_events_in_file_order(self):
+        items = list(AssParser.iterate_script(get_file_in_test_directory('3.ass')))
+        self.assertIsInstance(items[0], AssParser.AssStyle)
+        self.assertIsInstance(items[-1], AssParser.AssEvent)
+
+    def test_read_script_returns_same_data_as_iterate_script(self):
+        styles, events = AssParser.read_script(get_file_in_test_directory('1.ass'))
+        items = list(AssParser.iterate_script(get_file_in_test_directory('1.ass')))
+        self.assertEqual(len(styles) + len(events), len(items))
+        self.assertEqual(events, [x for x in items if isinstance(x, AssParser.AssEvent)])
+
+    def test_processes_events_using_styles_defined_later(self):
+        with tempfile.NamedTemporaryFile('wb', suffix='.ass', delete=False) as file:
+            file.write(b'Dialogue: 0,0:00:00.00,0:00:01.00,Late,,0,0,0,,{\\rOther}text\r\n'
+                       b'Style: Late,Font,20,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,2,2,2,10,10,10,1\r\n'
+                       b'Style: Other,Other Font,20,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,-1,0,0,0,100,100,0,0,1,2,2,2,10,10,10,1\r\n')
+        try:
+            stat = AssParser.get_fonts_statistics(file.name, True, False)
+        finally:
+            os.remove(file.name)
+        self.assertEqual(['Other Font'], [x.fontname for x in stat.keys()])
+
+    def test_uses_event_cache_for_repeated_lines(self):
+        cache = EventCache()
+        AssParser.get_fonts_statistics(get_file_in_test_directory('1.ass'), False, False, cache)
+        self.assertGreater(cache.misses, 0)
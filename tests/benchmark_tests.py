@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ass_parser import AssParser
+from benchmarks import generate_font_directory, generate_script, make_collection, make_renamed_font, get_source_font_path
+from font_loader import FontLoader, TTFFont, TTCFont, parse_font_file
+
+
+class BenchmarkCorpusTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_renames_font_family(self):
+        path = os.path.join(self.directory, 'renamed.ttf')
+        with open(path, 'wb') as file:
+            file.write(make_renamed_font(get_source_font_path('Jorvik.ttf'), 'Bench Jorvik'))
+        self.assertIn('Bench Jorvik', TTFFont(path).get_info().names)
+
+    def test_joins_fonts_into_collection(self):
+        path = os.path.join(self.directory, 'joined.ttc')
+        with open(path, 'wb') as file:
+            file.write(make_collection([make_renamed_font(get_source_font_path('Jorvik.ttf'), 'First'),
+                                        make_renamed_font(get_source_font_path('seriously.ttf'), 'Second')]))
+        infos = TTCFont(path).get_infos()
+        self.assertEqual(['First', 'Second'], [sorted(x.names)[0] for x in infos])
+        self.assertEqual(set(), infos[1].get_missing_chars('abc'))
+
+    def test_generated_script_uses_generated_fonts(self):
+        families = generate_font_directory(self.directory, 12)
+        files = FontLoader.enumerate_font_files(self.directory)
+        names = set(name for path in files for info in parse_font_file(path) for name in info.names)
+        self.assertTrue(set(families).issubset(names))
+
+        path = os.path.join(self.directory, 'script.ass')
+        generate_script(path, families, 100, override_density=0.5, karaoke=0.5, drawing=0.1)
+        fonts = AssParser.get_fonts_statistics(path)
+        self.assertTrue(fonts)
+        self.assertTrue(set(x.fontname for x in fonts.keys()).issubset(families))
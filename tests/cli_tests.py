@@ -0,0 +1,184 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import logging
+import assfc
+from ass_parser import StyleInfo, UsageData
+from font_loader import FontLoader
+from misc.timings import timings
+from tests.common import get_file_in_test_directory, disabled_logging
+
+script_text = '''[Script Info]
+ScriptType: v4.00+
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,%s,40,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,2,2,2,10,10,10,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+Dialogue: 0,0:00:00.00,0:00:02.00,Default,,0,0,0,,%s
+'''
+
+
+def write_script(path, font, text = 'abc'):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(script_text % (font, text))
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scripts = os.path.join(self.directory, 'scripts')
+        os.makedirs(os.path.join(self.scripts, 'nested'))
+        write_script(os.path.join(self.scripts, 'first.ass'), 'Vanta Thin')
+        write_script(os.path.join(self.scripts, 'second.ass'), 'Susanna')
+        write_script(os.path.join(self.scripts, 'nested', 'third.ass'), 'Susanna')
+        with open(os.path.join(self.scripts, 'notes.txt'), 'w') as file:
+            file.write('not a script')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_cli(self, *args):
+        environment = dict(os.environ, ASSFC_DATA_DIR=os.path.join(self.directory, 'cache'))
+        os.makedirs(environment['ASSFC_DATA_DIR'], exist_ok=True)
+        return subprocess.run([sys.executable, 'assfc.py', '--without-system', '--no-daemon', '--include', get_file_in_test_directory('')] + list(args),
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=environment,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def write_broken_script(self):
+        path = os.path.join(self.scripts, 'broken.ass')
+        with open(path, 'wb') as file:
+            file.write(b'[Events]\nDialogue: 0,0:00:00.00,0:00:02.00,Default,,0,0,0,,\xff\xfe\n')
+        return path
+
+    def test_expands_directories_to_their_scripts(self):
+        self.assertEqual([os.path.join(self.scripts, 'first.ass'), os.path.join(self.scripts, 'second.ass')],
+                         assfc.expand_script_paths([self.scripts]))
+
+    def test_expands_wildcards(self):
+        self.assertEqual([os.path.join(self.scripts, 'nested', 'third.ass'), os.path.join(self.scripts, 'second.ass')],
+                         assfc.expand_script_paths([os.path.join(self.scripts, 'nested', '*.ass'), os.path.join(self.scripts, 's*.ass')]))
+
+    def test_skips_broken_scripts(self):
+        scripts = [os.path.join(self.scripts, 'first.ass'), self.write_broken_script(), os.path.join(self.directory, 'missing.ass')]
+        with disabled_logging(logging.CRITICAL):
+            statistics = assfc.get_scripts_statistics(scripts, False, False, 1)
+        self.assertEqual(3, len(statistics))
+        self.assertEqual(['Vanta Thin'], [x.fontname for x in statistics[0].keys()])
+        self.assertEqual([None, None], statistics[1:])
+
+    def test_skips_broken_scripts_in_worker_processes(self):
+        scripts = [self.write_broken_script(), os.path.join(self.scripts, 'second.ass')]
+        with disabled_logging(logging.CRITICAL):
+            statistics = assfc.get_scripts_statistics(scripts, False, False, 2)
+        self.assertIsNone(statistics[0])
+        self.assertEqual(['Susanna'], [x.fontname for x in statistics[1].keys()])
+
+    def test_writes_fonts_of_every_script_separately(self):
+        output = os.path.join(self.directory, 'output')
+        result = self.run_cli('--per-script', '-o', output, self.scripts)
+        self.assertEqual(0, result.returncode, result.stdout)
+        self.assertEqual(['VANTATHI.TTF'], os.listdir(os.path.join(output, 'first')))
+        self.assertEqual(['SUSANNA_.otf'], os.listdir(os.path.join(output, 'second')))
+
+    def test_writes_fonts_of_all_scripts_to_one_folder(self):
+        output = os.path.join(self.directory, 'output')
+        result = self.run_cli('-o', output, self.scripts)
+        self.assertEqual(0, result.returncode, result.stdout)
+        self.assertEqual(['SUSANNA_.otf', 'VANTATHI.TTF'], sorted(os.listdir(output)))
+
+    def test_parses_scripts_in_worker_processes_while_loading_fonts(self):
+        output = os.path.join(self.directory, 'output')
+        result = self.run_cli('-j', '2', '--per-script', '-o', output, self.scripts)
+        self.assertEqual(0, result.returncode, result.stdout)
+        self.assertEqual(['first', 'second'], sorted(os.listdir(output)))
+
+    def test_profiles_font_loading_thread(self):
+        import pstats
+        profile = os.path.join(self.directory, 'profile')
+        result = self.run_cli('--profile', profile, '-o', os.path.join(self.directory, 'output'), self.scripts)
+        self.assertEqual(0, result.returncode, result.stdout)
+        functions = [name for file, line, name in pstats.Stats(profile).stats.keys()]
+        self.assertIn('load_collector', functions)
+        self.assertIn('get_scripts_statistics', functions)
+
+    def test_processes_remaining_scripts_when_one_is_broken(self):
+        self.write_broken_script()
+        output = os.path.join(self.directory, 'output')
+        result = self.run_cli('--per-script', '-o', output, self.scripts)
+        self.assertEqual(1, result.returncode, result.stdout)
+        self.assertEqual(['first', 'second'], sorted(os.listdir(output)))
+
+
+class SubsetCharsTests(unittest.TestCase):
+    def test_merges_chars_of_styles_sharing_a_font(self):
+        loader = FontLoader([get_file_in_test_directory('')], False)
+        fonts = {StyleInfo('Seriously', 0, False): UsageData(), StyleInfo('Seriously', 1, False): UsageData()}
+        fonts[StyleInfo('Seriously', 0, False)].chars.update('abc')
+        fonts[StyleInfo('Seriously', 1, False)].chars.update('XYZ')
+        found, not_found = loader.get_fonts_for_list(fonts)
+        font_chars = assfc.get_font_chars(loader.resolved, fonts)
+        self.assertEqual(1, len(font_chars))
+        self.assertEqual(set('abcXYZ'), list(font_chars.values())[0][1])
+
+
+class LoadCollectorTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = dict(assfc.default_config, font_dirs=[get_file_in_test_directory('')], include_system_fonts=False,
+                           rebuild_cache=False, daemon_socket=os.path.join(self.directory, 'assfc.sock'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def find(self, collector, name):
+        found, not_found = collector.get_fonts_for_list({StyleInfo(name, 0, False): UsageData()})
+        return [x.path for x in found.values()]
+
+    def test_loads_fonts_without_font_server(self):
+        collector = assfc.load_collector(dict(self.config, use_daemon=False))
+        self.assertIsInstance(collector, FontLoader)
+        self.assertEqual([get_file_in_test_directory('VANTATHI.TTF')], self.find(collector, 'Vanta Thin'))
+
+    def test_loads_fonts_when_no_server_is_running(self):
+        self.assertIsInstance(assfc.load_collector(self.config), FontLoader)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix domain sockets are not supported')
+    def test_forwards_lookups_to_running_font_server(self):
+        from font_server import FontServer, FontClient
+        server = FontServer(self.config['daemon_socket'], FontLoader(self.config['font_dirs'], False), self.config['font_dirs'], False)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            collector = assfc.load_collector(self.config)
+            self.assertIsInstance(collector, FontClient)
+            self.assertEqual([get_file_in_test_directory('VANTATHI.TTF')], self.find(collector, 'Vanta Thin'))
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+class ReportOverlapTests(unittest.TestCase):
+    def setUp(self):
+        timings.enabled = True
+        timings.reset()
+
+    def tearDown(self):
+        timings.enabled = False
+        timings.reset()
+
+    def test_records_time_both_stages_ran_at_once(self):
+        assfc.report_overlap(2.0, 3.0, 4.0)
+        self.assertAlmostEqual(1.0, timings.stages['overlap'][0])
+
+    def test_records_no_overlap_of_sequential_stages(self):
+        assfc.report_overlap(1.0, 1.0, 3.0)
+        self.assertEqual(0.0, timings.stages['overlap'][0])
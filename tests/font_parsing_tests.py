@@ -1,9 +1,18 @@
+from array import array
 import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
 from functools import reduce
 from ass_parser import StyleInfo, UsageData
 from font_loader import TTFFont, FontInfo, FontLoader, TTCFont, FontWeight
-from tests.common import get_file_in_test_directory
+from font_loader.font_cache import FontCache, LayeredFontCache, get_file_stat
+from font_loader.font_index import FontIndex
+from font_loader.subsetter import write_subset_font, read_table_directory, get_check_sum, build_cmap_table
+from tests.common import get_file_in_test_directory, disabled_logging
 
 class FontLoaderTests(unittest.TestCase):
     def test_returns_all_not_found_fonts(self):
@@ -25,6 +34,14 @@ class FontLoaderTests(unittest.TestCase):
         found, not_found = loader.get_fonts_for_list(data)
         self.assertEqual(1, len(found))
 
+    def test_resolves_styles_sharing_a_font(self):
+        loader = FontLoader([get_file_in_test_directory('')], False)
+        data = {StyleInfo('Seriously', 0, False) : UsageData(), StyleInfo('Seriously', 1, False) : UsageData()}
+        found, not_found = loader.get_fonts_for_list(data)
+        self.assertEqual(1, len(found))
+        self.assertEqual(set(data.keys()), set(loader.resolved.keys()))
+        self.assertEqual(1, len(set(x.path for x in loader.resolved.values())))
+
     def test_does_not_add_same_font_twice(self):
         loader = FontLoader([get_file_in_test_directory(''), get_file_in_test_directory('')], True)
         data = {StyleInfo('Jorvik', 0, False) : UsageData(), StyleInfo('Jorvik informal', 0, False) : UsageData()}
@@ -51,6 +68,85 @@ class FontLoaderTests(unittest.TestCase):
         found, not_found = loader.get_fonts_for_list(data)
         self.assertEqual(1, len(found))
 
+    def test_prefers_font_covering_used_characters(self):
+        loader = FontLoader(None, True)
+        loader.fonts.append(FontInfo(['Arial'], False, False, FontWeight.FW_NORMAL, 'basic', '1', array('I', [32, 127])))
+        loader.fonts.append(FontInfo(['Arial'], False, False, FontWeight.FW_NORMAL, 'full', '2', array('I', [32, 1280])))
+        usage = UsageData()
+        usage.chars.update('Привет')
+        found, not_found = loader.get_fonts_for_list({StyleInfo('Arial', 0, False) : usage})
+        self.assertEqual('full', list(found.values())[0].path)
+        self.assertEqual({}, loader.missing_glyphs)
+
+    def test_reports_characters_missing_from_found_font(self):
+        loader = FontLoader(None, True)
+        loader.fonts.append(FontInfo(['Arial'], False, False, FontWeight.FW_NORMAL, 'basic', '1', array('I', [32, 127])))
+        usage = UsageData()
+        usage.chars.update('Hi мир')
+        style = StyleInfo('Arial', 0, False)
+        found, not_found = loader.get_fonts_for_list({style : usage})
+        self.assertEqual(1, len(found))
+        self.assertEqual(set('мир'), loader.missing_glyphs[style])
+
+    def test_parallel_scan_returns_same_fonts_as_serial_scan(self):
+        paths = FontLoader.enumerate_font_files(get_file_in_test_directory(''))
+        serial = FontLoader.scan_fonts(paths, 1)
+        parallel = FontLoader.scan_fonts(paths, 2)
+        self.assertEqual(set(serial.keys()), set(parallel.keys()))
+        #workers are fresh interpreters with their own hash seed, so names collected in sets come in another order
+        for path, infos in serial.items():
+            self.assertEqual([sorted(x.names) for x in infos], [sorted(x.names) for x in parallel[path]])
+
+    def test_scan_skips_broken_files(self):
+        with disabled_logging(logging.ERROR):
+            fonts = FontLoader.scan_fonts([get_file_in_test_directory('1.ass'), get_file_in_test_directory('Jorvik.ttf')], 2)
+        self.assertEqual([get_file_in_test_directory('Jorvik.ttf')], list(fonts.keys()))
+
+class DuplicateFontsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), os.path.join(self.directory, 'a.ttf'))
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), os.path.join(self.directory, 'b.ttf'))
+        shutil.copy(get_file_in_test_directory('seriously.ttf'), os.path.join(self.directory, 'c.ttf'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def find_regular_and_italic(self, regular_file, italic_file):
+        self.loader = loader = FontLoader(None, False)
+        loader.fonts.append(FontInfo(['Same'], False, False, FontWeight.FW_NORMAL, os.path.join(self.directory, regular_file), None))
+        loader.fonts.append(FontInfo(['Same'], False, True, FontWeight.FW_NORMAL, os.path.join(self.directory, italic_file), None))
+        data = {StyleInfo('Same', 0, False) : UsageData(), StyleInfo('Same', 0, True) : UsageData()}
+        with disabled_logging(logging.INFO):
+            return loader.get_fonts_for_list(data)
+
+    def test_skips_font_with_same_content_at_different_path(self):
+        found, not_found = self.find_regular_and_italic('a.ttf', 'b.ttf')
+        self.assertEqual([os.path.join(self.directory, 'a.ttf')], [x.path for x in found.values()])
+
+    def test_resolves_skipped_duplicate_to_kept_font(self):
+        found, not_found = self.find_regular_and_italic('a.ttf', 'b.ttf')
+        self.assertEqual([os.path.join(self.directory, 'a.ttf')] * 2, [x.path for x in self.loader.resolved.values()])
+
+    def test_keeps_fonts_with_different_content(self):
+        found, not_found = self.find_regular_and_italic('a.ttf', 'c.ttf')
+        self.assertEqual(2, len(found))
+
+    def test_calculates_and_stores_file_hashes(self):
+        paths = [os.path.join(self.directory, x) for x in ['a.ttf', 'c.ttf']]
+        loader = FontLoader(None, False, cache_path=os.path.join(self.directory, 'cache'))
+        hashes = loader.get_file_hashes(paths, True)
+        self.assertEqual('0dae05c47e919281d7ac1e0170e4d3a8', hashes[paths[0]])
+        cache = FontCache(loader.cache_path)
+        self.assertEqual('0dae05c47e919281d7ac1e0170e4d3a8', cache.get_hashes(paths)[paths[0]][3])
+        cache.close()
+
+    def test_partial_hash_differs_for_different_files(self):
+        paths = [os.path.join(self.directory, x) for x in ['a.ttf', 'b.ttf', 'c.ttf']]
+        hashes = FontLoader(None, False, cache_path=os.path.join(self.directory, 'cache')).get_file_hashes(paths, False)
+        self.assertEqual(hashes[paths[0]], hashes[paths[1]])
+        self.assertNotEqual(hashes[paths[0]], hashes[paths[2]])
+
 class TTFFontTests(unittest.TestCase):
     def test_ttf_name_matches(self):
         font = TTFFont(get_file_in_test_directory('seriously.ttf'))
@@ -97,13 +193,433 @@ class TTFFontTests(unittest.TestCase):
         font = TTFFont(get_file_in_test_directory('seriously.ttf'))
         self.assertEqual(font.get_info().weight, FontWeight.FW_MEDIUM)
 
+    def test_parses_font_from_memory_buffer(self):
+        with open(get_file_in_test_directory('seriously.ttf'), 'rb') as file:
+            data = file.read()
+        font = TTFFont('seriously.ttf', 0, data)
+        self.assertIn('Seriously', font.get_info().names)
+        self.assertEqual(font.get_info().weight, FontWeight.FW_MEDIUM)
+
+    def test_fast_scan_decodes_only_required_names(self):
+        font = TTFFont(get_file_in_test_directory('Jorvik.ttf'))
+        self.assertNotIn(TTFFont.TTFNameId.Trademark, font._TTFFont__headers)
+        self.assertIn(TTFFont.TTFNameId.FontFamilyName, font._TTFFont__headers)
+
+    def test_decodes_all_headers_on_access(self):
+        font = TTFFont(get_file_in_test_directory('Jorvik.ttf'))
+        self.assertEqual(font.headers[TTFFont.TTFNameId.Version], ['0.90', '0.90', '0.90'])
+        self.assertEqual(len(font.headers[TTFFont.TTFNameId.FontFamilyName]), 3)
+
+    def test_fast_scan_keeps_no_copy_of_name_table(self):
+        font = TTFFont(get_file_in_test_directory('Jorvik.ttf'))
+        self.assertIsNone(font._TTFFont__name_table)
+
+    def test_decodes_all_headers_of_font_read_from_buffer(self):
+        with open(get_file_in_test_directory('Jorvik.ttf'), 'rb') as file:
+            data = file.read()
+        font = TTFFont('missing.ttf', 0, data, keep_names=True)
+        self.assertEqual(font.headers[TTFFont.TTFNameId.Version], ['0.90', '0.90', '0.90'])
+
+    def test_reads_cmap_coverage(self):
+        info = TTFFont(get_file_in_test_directory('seriously.ttf')).get_info()
+        self.assertEqual({'é', 'Ж'}, info.get_missing_chars('Seé Ж'))
+
+    def test_reads_coverage_of_ttc_subfonts(self):
+        infos = TTCFont(get_file_in_test_directory('jorvik_and_seriously.ttc')).get_infos()
+        self.assertTrue(all(x.coverage is not None and 'A' not in x.get_missing_chars('A') for x in infos))
+
+    def test_full_scan_returns_same_info_as_fast_scan(self):
+        fast = TTFFont(get_file_in_test_directory('CaviarDreams_BoldItalic.ttf')).get_info()
+        full = TTFFont(get_file_in_test_directory('CaviarDreams_BoldItalic.ttf'), fast_scan=False).get_info()
+        self.assertEqual(sorted(fast.names), sorted(full.names))
+        self.assertEqual((fast.bold, fast.italic, fast.weight), (full.bold, full.italic, full.weight))
+
 class TTCFontTests(unittest.TestCase):
     def test_contains_all_names(self):
         font = TTCFont(get_file_in_test_directory('jorvik_and_seriously.ttc'))
         self.assertIn('Seriously', reduce(lambda names, info: names + info.names, font.get_infos(), []))
         self.assertIn('Jorvik Informal V2', reduce(lambda names, info: names + info.names, font.get_infos(), []))
 
+class SubsetterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_glyphs(self, path):
+        with open(path, 'rb') as file:
+            data = file.read()
+        tables = read_table_directory(data, 0)[1]
+        head, maxp, loca, glyf = (tables[x][0] for x in (b'head', b'maxp', b'loca', b'glyf'))
+        num_glyphs = struct.unpack_from('>H', data, maxp + 4)[0]
+        if struct.unpack_from('>h', data, head + 50)[0]:
+            offsets = struct.unpack_from('>%iI' % (num_glyphs + 1), data, loca)
+        else:
+            offsets = [x * 2 for x in struct.unpack_from('>%iH' % (num_glyphs + 1), data, loca)]
+        return data, [data[glyf + offsets[x]:glyf + offsets[x + 1]] for x in range(num_glyphs)]
+
+    def test_keeps_only_used_characters(self):
+        info = TTFFont(get_file_in_test_directory('Jorvik.ttf')).get_info()
+        path = write_subset_font(info, 'Hello', self.directory)
+        subset = TTFFont(path).get_info()
+        self.assertEqual(set(info.names), set(subset.names))
+        self.assertEqual(set(), subset.get_missing_chars('Hello '))
+        self.assertEqual({'z', 'A'}, subset.get_missing_chars('Az'))
+        self.assertLess(os.path.getsize(path), os.path.getsize(info.path) / 2)
+
+    def test_keeps_glyph_ids_and_outlines_of_used_glyphs(self):
+        original_data, original = self.read_glyphs(get_file_in_test_directory('Jorvik.ttf'))
+        info = TTFFont(get_file_in_test_directory('Jorvik.ttf')).get_info()
+        data, subset = self.read_glyphs(write_subset_font(info, 'Hello', self.directory))
+        self.assertEqual(len(original), len(subset))
+        self.assertEqual(original[0], subset[0])
+        self.assertLess(sum(1 for x in subset if x), sum(1 for x in original if x))
+        self.assertTrue(all(not x or x == original[i] for i, x in enumerate(subset)))
+
+    def test_writes_valid_checksums(self):
+        info = TTFFont(get_file_in_test_directory('seriously.ttf')).get_info()
+        with open(write_subset_font(info, 'abc', self.directory), 'rb') as file:
+            data = file.read()
+        self.assertEqual(0xB1B0AFBA, get_check_sum(data))
+        for index in range(struct.unpack_from('>H', data, 4)[0]):
+            tag, check_sum, offset, length = struct.unpack_from('>4sLLL', data, 12 + index * 16)
+            if tag != b'head':
+                self.assertEqual(check_sum, get_check_sum(data[offset:offset + length]))
+
+    def get_cmap_records(self, cmap):
+        count = struct.unpack_from('>H', cmap, 2)[0]
+        return [(platform_id, encoding_id, struct.unpack_from('>H', cmap, offset)[0])
+                for platform_id, encoding_id, offset in (struct.unpack_from('>HHI', cmap, 4 + x * 8) for x in range(count))]
+
+    def test_writes_bmp_subtable_as_windows_unicode_bmp(self):
+        self.assertEqual([(3, 1, 4)], self.get_cmap_records(build_cmap_table(3, 10, {0x41: 1, 0x4E00: 2})))
+
+    def test_writes_characters_outside_bmp_only_as_windows_unicode_full(self):
+        self.assertEqual([(3, 1, 4), (3, 10, 12)], self.get_cmap_records(build_cmap_table(3, 10, {0x41: 1, 0x20000: 2})))
+        self.assertEqual([(3, 1, 4), (3, 10, 12)], self.get_cmap_records(build_cmap_table(0, 4, {0x41: 1, 0x20000: 2})))
+
+    def test_keeps_symbol_subtable_of_symbol_fonts(self):
+        self.assertEqual([(3, 0, 4)], self.get_cmap_records(build_cmap_table(3, 0, {0xF041: 1})))
+
+    def test_extracts_collection_members(self):
+        infos = TTCFont(get_file_in_test_directory('jorvik_and_seriously.ttc')).get_infos()
+        paths = [write_subset_font(x, 'Hi', self.directory) for x in infos]
+        self.assertEqual(2, len(set(paths)))
+        self.assertEqual([set(x.names) for x in infos], [set(TTFFont(x).get_info().names) for x in paths])
+
+    def test_copies_fonts_without_glyf_outlines(self):
+        info = TTFFont(get_file_in_test_directory('otfpoc.otf')).get_info()
+        path = write_subset_font(info, 'Hi', self.directory)
+        self.assertEqual(os.path.getsize(info.path), os.path.getsize(path))
+
+class FontCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'font_cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_returns_stored_fonts_and_stats(self):
+        font_path = get_file_in_test_directory('Jorvik.ttf')
+        stat = get_file_stat(font_path)
+        cache = FontCache(self.path)
+        cache.update({font_path: (stat, [TTFFont(font_path).get_info()])})
+        cache.close()
+
+        cache = FontCache(self.path)
+        self.assertEqual({font_path: stat}, cache.get_stats())
+        self.assertIn('Jorvik Informal V2', cache.get_fonts()[font_path][0].names)
+        cache.close()
+
+    def test_removes_fonts(self):
+        cache = FontCache(self.path)
+        cache.update({'a': ((1, 2, 3), []), 'b': ((1, 2, 3), [])})
+        cache.remove(['a'])
+        self.assertEqual(['b'], list(cache.get_stats().keys()))
+        cache.close()
+
+    def test_replaces_entry_of_modified_file(self):
+        cache = FontCache(self.path)
+        cache.update({'a': ((1, 2, 3), [])})
+        cache.update({'a': ((4, 5, 6), [])})
+        self.assertEqual({'a': (4, 5, 6)}, cache.get_stats())
+        cache.close()
+
+    def test_stores_lowercase_name_index(self):
+        cache = FontCache(self.path)
+        cache.update({'a': ((1, 2, 3), [FontInfo(['Font', 'FONT Bold'], True, False, 700, 'a', None)])})
+        self.assertEqual(sorted([('font', 'a', 0), ('font bold', 'a', 0)]), sorted(cache.get_name_index()))
+        cache.close()
+
+    def test_updates_name_index_of_modified_and_removed_files(self):
+        cache = FontCache(self.path)
+        cache.update({'a': ((1, 2, 3), [FontInfo(['Old'], False, False, 400, 'a', None)]),
+                      'b': ((1, 2, 3), [FontInfo(['Other'], False, False, 400, 'b', None)])})
+        cache.update({'a': ((4, 5, 6), [FontInfo(['New'], False, False, 400, 'a', None)])})
+        cache.remove(['b'])
+        self.assertEqual([('new', 'a', 0)], cache.get_name_index())
+        cache.close()
+
+    def test_recreates_broken_cache_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'definitely not a database' * 100)
+        with disabled_logging(logging.WARNING):
+            cache = FontCache(self.path)
+        self.assertEqual({}, cache.get_stats())
+        cache.close()
+
+class LayeredFontCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.shared = os.path.join(self.directory, 'shared')
+        self.personal = os.path.join(self.directory, 'personal')
+        os.makedirs(self.personal)
+        shutil.copytree(get_file_in_test_directory(''), self.shared, ignore=shutil.ignore_patterns('*.ass'))
+        self.base = os.path.join(self.directory, 'base.db')
+        self.overlay = os.path.join(self.directory, 'overlay.db')
+        FontLoader([self.shared], False, cache_path=self.base)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, font_dirs = None):
+        return FontLoader(font_dirs or [self.shared], False, shared_cache=self.base, cache_path=self.overlay)
+
+    def get_overlay_stats(self):
+        cache = FontCache(self.overlay)
+        try:
+            return cache.get_stats()
+        finally:
+            cache.close()
+
+    def find(self, loader, name):
+        found, not_found = loader.get_fonts_for_list({StyleInfo(name, 0, False) : UsageData()})
+        return list(found.values())
+
+    def test_overlay_is_empty_for_unchanged_shared_fonts(self):
+        loader = self.load()
+        self.assertEqual({}, self.get_overlay_stats())
+        self.assertEqual(1, len(self.find(loader, 'Vanta Thin')))
+
+    def test_drops_fonts_of_full_cache_used_before_layering(self):
+        FontLoader([self.shared], False, cache_path=self.overlay)
+        self.assertNotEqual({}, self.get_overlay_stats())
+        loader = self.load()
+        self.assertEqual({}, self.get_overlay_stats())
+        cache = FontCache(self.overlay)
+        try:
+            self.assertEqual({}, cache.get_directories())
+        finally:
+            cache.close()
+        self.assertEqual(1, len(self.find(loader, 'Vanta Thin')))
+
+    def test_overlay_records_only_personal_fonts(self):
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), os.path.join(self.personal, 'mine.ttf'))
+        loader = self.load([self.shared, self.personal])
+        self.assertEqual([os.path.join(self.personal, 'mine.ttf')], list(self.get_overlay_stats().keys()))
+        self.assertIn(os.path.join(self.personal, 'mine.ttf'), [x.path for x in loader.fonts])
+
+    def test_hides_shared_fonts_removed_for_user(self):
+        os.remove(os.path.join(self.shared, 'VANTATHI.TTF'))
+        loader = self.load()
+        self.assertEqual([], self.find(loader, 'Vanta Thin'))
+        self.assertEqual({os.path.join(self.shared, 'VANTATHI.TTF'): (None, None, None)}, self.get_overlay_stats())
+
+    def test_drops_overlay_entry_matching_base_again(self):
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), os.path.join(self.personal, 'mine.ttf'))
+        self.load([self.shared, self.personal])
+        self.load()
+        self.assertEqual({}, self.get_overlay_stats())
+
+    def test_never_writes_to_base(self):
+        os.remove(os.path.join(self.shared, 'VANTATHI.TTF'))
+        before = get_file_stat(self.base)
+        self.load()
+        self.assertEqual(before[:2], get_file_stat(self.base)[:2])
+        cache = FontCache(self.base, read_only=True)
+        try:
+            with self.assertRaises(Exception):
+                cache.remove([os.path.join(self.shared, 'Jorvik.ttf')])
+        finally:
+            cache.close()
+
+class FontLoaderReloadTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fonts = os.path.join(self.directory, 'fonts')
+        os.makedirs(self.fonts)
+        self.font = os.path.join(self.fonts, 'x.ttf')
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), self.font)
+        self.cache = os.path.join(self.directory, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_notices_font_replaced_in_place(self):
+        loader = FontLoader([self.fonts], False, cache_path=self.cache)
+        directory_mtime = os.stat(self.fonts).st_mtime_ns
+        shutil.copyfile(get_file_in_test_directory('seriously.ttf'), self.font)
+        os.utime(self.fonts, ns=(directory_mtime, directory_mtime))
+        self.assertEqual(1, loader.reload())
+        names = FontLoader([self.fonts], False, cache_path=self.cache).fonts[0].names
+        self.assertIn('Seriously', names)
+        self.assertNotIn('Jorvik Informal V2', names)
+
+    def test_matches_manifest_of_root_given_with_trailing_separator(self):
+        FontLoader([self.fonts + os.sep], False, cache_path=self.cache)
+        cache = FontCache(self.cache)
+        try:
+            self.assertEqual([self.fonts], list(cache.get_directories().keys()))
+        finally:
+            cache.close()
+
+
+class ConcurrentCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fonts = os.path.join(self.directory, 'fonts')
+        shutil.copytree(get_file_in_test_directory(''), self.fonts, ignore=shutil.ignore_patterns('*.ass'))
+        self.cache = os.path.join(self.directory, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @unittest.skipIf(os.name == 'nt', 'Windows has no shared locks')
+    def test_waits_for_cache_being_rebuilt_instead_of_scanning(self):
+        from misc.file_lock import locked
+        loaders = []
+        with locked(self.cache + '.lock'):
+            thread = threading.Thread(target=lambda: loaders.append(FontLoader([self.fonts], False, cache_path=self.cache)))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            #stands in for the process holding the lock
+            FontLoader([self.fonts], False, cache_path=self.cache + '.other')
+            shutil.copy(self.cache + '.other', self.cache)
+            shutil.copy(self.cache + '.other.index', self.cache + '.index')
+            written = get_file_stat(self.cache), get_file_stat(self.cache + '.index')
+        thread.join()
+        self.assertEqual(written, (get_file_stat(self.cache), get_file_stat(self.cache + '.index')))
+        self.assertNotEqual([], loaders[0].fonts)
+
+    @unittest.skipIf(os.name == 'nt', 'Windows has no shared locks')
+    def test_migrates_outdated_cache_only_under_exclusive_lock(self):
+        import sqlite3
+        from misc.file_lock import locked
+        connection = sqlite3.connect(self.cache)
+        connection.execute('PRAGMA user_version = 1')
+        connection.close()
+        loaders = []
+        with locked(self.cache + '.lock', False):
+            thread = threading.Thread(target=lambda: loaders.append(FontLoader([self.fonts], False, cache_path=self.cache)))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            connection = sqlite3.connect(self.cache)
+            self.assertEqual(1, connection.execute('PRAGMA user_version').fetchone()[0])
+            connection.close()
+        thread.join()
+        self.assertNotEqual([], loaders[0].fonts)
+
+    @unittest.skipIf(os.name == 'nt', 'Windows has no shared locks')
+    def test_reads_fonts_of_outdated_cache_only_under_exclusive_lock(self):
+        import sqlite3
+        from misc.file_lock import locked
+        loader = FontLoader([self.fonts], False, cache_path=self.cache)
+        connection = sqlite3.connect(self.cache)
+        connection.execute('PRAGMA user_version = 1')
+        connection.close()
+        fonts = []
+        with locked(self.cache + '.lock', False):
+            thread = threading.Thread(target=lambda: fonts.append(loader.fonts))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual([], fonts[0])
+
+    def test_enumerates_fonts_once_when_updating_cache(self):
+        from misc.timings import timings
+        timings.enabled = True
+        timings.reset()
+        try:
+            FontLoader([self.fonts], False, cache_path=self.cache)
+            self.assertEqual(1, timings.stages['enumeration'][1])
+            self.assertEqual(1, timings.stages['file stat'][1])
+        finally:
+            timings.enabled = False
+            timings.reset()
+
+    def test_second_loader_finds_nothing_to_update(self):
+        FontLoader([self.fonts], False, cache_path=self.cache)
+        self.assertEqual(0, FontLoader([self.fonts], False, cache_path=self.cache).reload())
+
+    def test_rebuilds_index_of_recreated_cache(self):
+        FontLoader([self.fonts], False, cache_path=self.cache)
+        os.remove(self.cache)
+        os.remove(os.path.join(self.fonts, 'VANTATHI.TTF'))
+        loader = FontLoader([self.fonts], False, cache_path=self.cache)
+        found, not_found = loader.get_fonts_for_list({StyleInfo('Vanta Thin', 0, False): UsageData()})
+        self.assertEqual({}, found)
+
+    def test_index_writes_leave_no_temporary_files(self):
+        FontLoader([self.fonts], False, cache_path=self.cache)
+        FontIndex.write(self.cache + '.index', 1, 1, {}, [])
+        self.assertEqual([], [x for x in os.listdir(self.directory) if x.endswith('.tmp')])
+
+
+class FontIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'font_index.bin')
+        fonts = {'a.ttf': [FontInfo(['Font', 'Font Regular'], False, False, 400, 'a.ttf', None, array('I', [32, 127, 1024, 1280]))],
+                 'b.ttc': [FontInfo(['Font'], True, False, 700, 'b.ttc', None),
+                           FontInfo(['Другой'], False, True, 400, 'b.ttc', None)]}
+        index = [('font', 'a.ttf', 0), ('font regular', 'a.ttf', 0), ('font', 'b.ttc', 0), ('другой', 'b.ttc', 1)]
+        FontIndex.write(self.path, 7, 12, fonts, index)
+        self.index = FontIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_finds_all_candidates_in_order(self):
+        candidates = self.index.find('Font')
+        self.assertEqual(['a.ttf', 'b.ttc'], [x.path for x in candidates])
+        self.assertEqual((True, False, 700), (candidates[1].bold, candidates[1].italic, candidates[1].weight))
+
+    def test_finds_non_ascii_names(self):
+        candidates = self.index.find('ДРУГОЙ')
+        self.assertEqual(['Другой'], candidates[0].names)
+        self.assertTrue(candidates[0].italic)
+
+    def test_returns_empty_list_for_unknown_name(self):
+        self.assertEqual([], self.index.find('fon'))
+        self.assertEqual([], self.index.find('zzz'))
+
+    def test_returns_same_object_for_same_font(self):
+        self.assertIs(self.index.find('font')[0], self.index.find('font regular')[0])
+
+    def test_stores_coverage(self):
+        candidates = self.index.find('font')
+        self.assertEqual(array('I', [32, 127, 1024, 1280]), candidates[0].coverage)
+        self.assertIsNone(candidates[1].coverage)
+
+    def test_stores_generation(self):
+        self.assertEqual((7, 12), (self.index.cache_id, self.index.generation))
+        self.assertEqual(3, len(self.index))
+
 class FontInfoTests(unittest.TestCase):
+    def test_returns_missing_chars(self):
+        info = FontInfo([], False, False, 0, 'random', None, array('I', [48, 58, 65, 91]))
+        self.assertEqual({'a', '@'}, info.get_missing_chars('09AZa@'))
+
+    def test_assumes_full_coverage_when_unknown(self):
+        info = FontInfo([], False, False, 0, 'random', None)
+        self.assertEqual(set(), info.get_missing_chars('Ж€'))
+
     def test_calculates_md5_on_access(self):
         info = FontInfo([], False, False, 0, get_file_in_test_directory('Jorvik.ttf'), None)
         self.assertIsNotNone(info.md5)
@@ -0,0 +1,293 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from ass_parser import AssParser
+from misc import scandir_enumerate_directory, manifest_enumerate_directory
+from misc.timings import Timings, timings
+from misc.file_copy import copy_file, copy_files, are_files_identical
+from misc.file_lock import locked, try_lock
+from misc import matroska
+from tests.common import get_file_in_test_directory
+
+
+class DirectoryEnumerationTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for path in ['a.ttf', 'b.txt', 'sub/c.otf', 'sub/deeper/d.ttc', 'sub/deeper/e.txt']:
+            path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_returns_same_files_as_os_walk(self):
+        expected = [os.path.join(path, name) for path, subdirs, files in os.walk(self.directory) for name in files]
+        self.assertEqual(sorted(expected), sorted(scandir_enumerate_directory(self.directory)))
+
+    def test_filters_files_during_walk(self):
+        files = scandir_enumerate_directory(self.directory, lambda x: not x.endswith('.txt'))
+        self.assertEqual(['a.ttf', 'c.otf', 'd.ttc'], sorted(os.path.basename(x) for x in files))
+
+    def test_reports_listing_time_of_every_directory(self):
+        timings = {}
+        scandir_enumerate_directory(self.directory, timings=timings)
+        self.assertEqual({self.directory, os.path.join(self.directory, 'sub'), os.path.join(self.directory, 'sub', 'deeper')},
+                         set(timings.keys()))
+
+    def test_returns_nothing_for_missing_directory(self):
+        self.assertEqual([], scandir_enumerate_directory(os.path.join(self.directory, 'missing')))
+
+    def test_manifest_walk_returns_same_files_as_full_walk(self):
+        files, entries = manifest_enumerate_directory(self.directory, None, {})
+        self.assertEqual(sorted(scandir_enumerate_directory(self.directory)), sorted(files))
+        self.assertEqual(3, len(entries))
+        self.assertFalse(any(unchanged for entry, unchanged in entries.values()))
+
+    def test_manifest_walk_reports_time_of_every_directory(self):
+        timings = {}
+        manifest_enumerate_directory(self.directory, None, {}, timings=timings)
+        self.assertEqual({self.directory, os.path.join(self.directory, 'sub'), os.path.join(self.directory, 'sub', 'deeper')},
+                         set(timings.keys()))
+
+    def test_manifest_walk_reuses_listings_of_unchanged_directories(self):
+        files, entries = manifest_enumerate_directory(self.directory, None, {})
+        manifest = {path: entry for path, (entry, unchanged) in entries.items()}
+        files_again, entries = manifest_enumerate_directory(self.directory, None, manifest)
+        self.assertEqual(sorted(files), sorted(files_again))
+        self.assertTrue(all(unchanged for entry, unchanged in entries.values()))
+
+    def test_manifest_walk_lists_changed_directories_again(self):
+        files, entries = manifest_enumerate_directory(self.directory, None, {})
+        manifest = {path: entry for path, (entry, unchanged) in entries.items()}
+        subdir = os.path.join(self.directory, 'sub')
+        manifest[subdir] = (manifest[subdir][0] - 1,) + manifest[subdir][1:]
+        open(os.path.join(subdir, 'new.ttf'), 'w').close()
+        files, entries = manifest_enumerate_directory(self.directory, None, manifest)
+        self.assertIn(os.path.join(subdir, 'new.ttf'), files)
+        self.assertFalse(entries[subdir][1])
+        self.assertTrue(entries[self.directory][1])
+
+
+class TimingsTests(unittest.TestCase):
+    def tearDown(self):
+        timings.enabled = False
+        timings.reset()
+
+    def test_records_nothing_when_disabled(self):
+        recorder = Timings()
+        with recorder.stage('stage'):
+            pass
+        recorder.add_item('files', 'a', 1.0)
+        self.assertEqual({}, recorder.to_json()['slowest'])
+        self.assertEqual([], recorder.to_json()['stages'])
+
+    def test_sums_up_stage_calls(self):
+        recorder = Timings()
+        recorder.enabled = True
+        recorder.add('stage', 1.0, 5)
+        recorder.add('stage', 2.0, 3)
+        self.assertEqual([{'name': 'stage', 'time': 3.0, 'calls': 2, 'count': 8}], recorder.to_json()['stages'])
+
+    def test_returns_slowest_items_first(self):
+        recorder = Timings()
+        recorder.enabled = True
+        for key, elapsed in [('a', 0.1), ('b', 0.3), ('c', 0.2)]:
+            recorder.add_item('files', key, elapsed)
+        self.assertEqual(['b', 'c'], [x[0] for x in recorder.get_slowest('files', 2)])
+
+    def test_records_script_stages(self):
+        timings.enabled = True
+        AssParser.get_fonts_statistics(get_file_in_test_directory('1.ass'))
+        self.assertEqual({'script read', 'event processing'}, set(timings.stages.keys()))
+
+
+class FileCopyTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source.ttf')
+        self.dest = os.path.join(self.directory, 'dest.ttf')
+        with open(self.source, 'wb') as file:
+            file.write(os.urandom(4096))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def test_copies_new_file(self):
+        self.assertIn(copy_file(self.source, self.dest, 'copy'), {'copied'})
+        self.assertEqual(self.read(self.source), self.read(self.dest))
+
+    def test_clones_or_falls_back_to_copy(self):
+        self.assertIn(copy_file(self.source, self.dest, 'clone'), {'cloned', 'copied'})
+        self.assertEqual(self.read(self.source), self.read(self.dest))
+        self.assertEqual(os.stat(self.source).st_mtime_ns, os.stat(self.dest).st_mtime_ns)
+
+    def test_skips_identical_file(self):
+        copy_file(self.source, self.dest, 'copy')
+        self.assertEqual('skipped', copy_file(self.source, self.dest, 'copy'))
+
+    def test_replaces_file_with_different_content_of_same_size(self):
+        with open(self.dest, 'wb') as file:
+            file.write(os.urandom(4096))
+        self.assertFalse(are_files_identical(self.source, self.dest))
+        self.assertEqual('copied', copy_file(self.source, self.dest, 'copy'))
+        self.assertEqual(self.read(self.source), self.read(self.dest))
+
+    @unittest.skipUnless(hasattr(os, 'link'), 'Hard links are not supported')
+    def test_links_file(self):
+        with open(self.dest, 'wb') as file:
+            file.write(b'old')
+        self.assertEqual('linked', copy_file(self.source, self.dest, 'hardlink'))
+        self.assertTrue(os.path.samefile(self.source, self.dest))
+        self.assertEqual('skipped', copy_file(self.source, self.dest, 'hardlink'))
+
+    @unittest.skipUnless(hasattr(os, 'link'), 'Hard links are not supported')
+    def test_replaces_linked_file_without_changing_its_original(self):
+        original = self.read(self.source)
+        other = os.path.join(self.directory, 'other.ttf')
+        with open(other, 'wb') as file:
+            file.write(os.urandom(4096))
+        copy_file(self.source, self.dest, 'hardlink')
+        for mode in ['copy', 'clone', 'hardlink']:
+            copy_file(other, self.dest, mode)
+            self.assertEqual(original, self.read(self.source))
+            self.assertEqual(self.read(other), self.read(self.dest))
+            copy_file(self.source, self.dest, 'hardlink')
+
+    def test_leaves_no_temporary_files(self):
+        copy_file(self.source, self.dest, 'copy')
+        self.assertEqual(['dest.ttf', 'source.ttf'], sorted(os.listdir(self.directory)))
+
+    def test_replaces_file_with_same_size_and_modification_time(self):
+        with open(self.dest, 'wb') as file:
+            data = self.read(self.source)
+            file.write(data[:-1] + bytes([data[-1] ^ 1]))
+        stat = os.stat(self.source)
+        os.utime(self.dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertFalse(are_files_identical(self.source, self.dest))
+
+    def test_copies_files_in_parallel(self):
+        pairs = [(self.source, os.path.join(self.directory, '%i.ttf' % x)) for x in range(5)]
+        self.assertEqual(5, copy_files(pairs, 'copy')['copied'])
+        self.assertEqual(5, copy_files(pairs, 'copy')['skipped'])
+
+
+def read_vint(data, pos, keep_marker):
+    length = 1
+    while not data[pos] & (0x80 >> (length - 1)):
+        length += 1
+    value = int.from_bytes(data[pos:pos + length], 'big')
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+    return value, pos + length
+
+def read_elements(data, pos = 0, end = None):
+    """Returns list of (id, payload) of the EBML elements in data[pos:end]"""
+    end = len(data) if end is None else end
+    elements = []
+    while pos < end:
+        id, pos = read_vint(data, pos, True)
+        size, pos = read_vint(data, pos, False)
+        elements.append((id, data[pos:pos + size]))
+        pos += size
+    if pos != end:
+        raise ValueError('Element sizes don\'t add up')
+    return elements
+
+def find_elements(data, *path):
+    elements = [(None, data)]
+    for id in path:
+        elements = [x for _, payload in elements for x in read_elements(payload) if x[0] == id]
+    return [x[1] for x in elements]
+
+
+@unittest.skipIf(sys.platform == 'win32', 'Windows has no shared locks')
+class FileLockTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def can_lock(self, exclusive):
+        #every open file has its own lock, so this conflicts with locks held in this process too
+        with open(self.path, 'a+b') as file:
+            return try_lock(file, exclusive, False)
+
+    def test_shared_locks_exclude_only_exclusive_ones(self):
+        with locked(self.path, False):
+            self.assertTrue(self.can_lock(False))
+            self.assertFalse(self.can_lock(True))
+
+    def test_exclusive_lock_excludes_everything(self):
+        with locked(self.path, True):
+            self.assertFalse(self.can_lock(False))
+            self.assertFalse(self.can_lock(True))
+
+    def test_releases_lock_after_block(self):
+        with locked(self.path, True):
+            pass
+        self.assertTrue(self.can_lock(True))
+
+    def test_waits_for_lock(self):
+        events = []
+        def read():
+            with locked(self.path, False):
+                events.append('read')
+        with locked(self.path, True):
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual(1, len(events))
+
+
+class MatroskaTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'out.mks')
+        self.fonts = [get_file_in_test_directory('Jorvik.ttf'), get_file_in_test_directory('seriously.ttf')]
+        matroska.write_mks_file(self.path, get_file_in_test_directory('1.ass'), self.fonts)
+        with open(self.path, 'rb') as file:
+            self.data = file.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_writes_consistent_element_sizes(self):
+        self.assertEqual([matroska.EBML, matroska.Segment], [x[0] for x in read_elements(self.data)])
+        self.assertEqual(b'matroska', find_elements(self.data, matroska.EBML, matroska.DocType)[0])
+
+    def test_attaches_font_files(self):
+        files = find_elements(self.data, matroska.Segment, matroska.Attachments, matroska.AttachedFile)
+        self.assertEqual([os.path.basename(x).encode('utf-8') for x in self.fonts],
+                         [find_elements(x, matroska.FileName)[0] for x in files])
+        for path, attached in zip(self.fonts, files):
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), find_elements(attached, matroska.FileData)[0])
+
+    def test_stores_script_as_ass_track(self):
+        codec = find_elements(self.data, matroska.Segment, matroska.Tracks, matroska.TrackEntry, matroska.CodecID)
+        self.assertEqual([b'S_TEXT/ASS'], codec)
+        private = find_elements(self.data, matroska.Segment, matroska.Tracks, matroska.TrackEntry, matroska.CodecPrivate)[0]
+        self.assertIn(b'[V4+ Styles]', private)
+        self.assertIn(b'[Events]', private)
+        self.assertNotIn(b'Dialogue:', private)
+
+    def test_writes_every_dialogue_line_as_block(self):
+        codec_private, events = matroska.split_script(get_file_in_test_directory('1.ass'))
+        blocks = find_elements(self.data, matroska.Segment, matroska.Cluster, matroska.BlockGroup, matroska.Block)
+        self.assertEqual(len(events), len(blocks))
+        self.assertEqual(set(x[2].encode('utf-8') for x in events), set(x[4:] for x in blocks))
+
+    def test_converts_event_times(self):
+        self.assertEqual(3723450, matroska.parse_ass_time('1:02:03.45'))
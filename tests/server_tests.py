@@ -0,0 +1,86 @@
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from ass_parser import StyleInfo, UsageData
+from font_loader import FontLoader
+from tests.common import get_file_in_test_directory, disabled_logging
+
+if hasattr(socket, 'AF_UNIX'):
+    from font_server import FontServer, FontClient, FontServerError
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix domain sockets are not supported')
+class FontServerTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.socket_path = os.path.join(cls.directory, 'assfc.sock')
+        cls.font_dirs = [get_file_in_test_directory('')]
+        loader = FontLoader(cls.font_dirs, False)
+        cls.server = FontServer(cls.socket_path, loader, cls.font_dirs, False)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+        cls.server.server_close()
+        shutil.rmtree(cls.directory)
+
+    def test_resolves_fonts(self):
+        client = FontClient(self.socket_path, self.font_dirs, False)
+        data = {StyleInfo('Jorvik Informal V2', 0, False) : UsageData(), StyleInfo('Random font', 0, False) : UsageData()}
+        found, not_found = client.get_fonts_for_list(data)
+        self.assertEqual(1, len(found))
+        self.assertIn('Jorvik Informal V2', list(found.values())[0].names)
+        self.assertIs(data[StyleInfo('Random font', 0, False)], not_found[StyleInfo('Random font', 0, False)])
+
+    def test_returns_missing_glyphs(self):
+        client = FontClient(self.socket_path, self.font_dirs, False)
+        usage = UsageData()
+        usage.chars.update('Sé')
+        style = StyleInfo('Seriously', 0, False)
+        client.get_fonts_for_list({style : usage})
+        self.assertEqual({style: {'é'}}, client.missing_glyphs)
+
+    def test_returns_all_resolved_styles(self):
+        client = FontClient(self.socket_path, self.font_dirs, False)
+        data = {StyleInfo('Seriously', 0, False) : UsageData(), StyleInfo('Seriously', 1, False) : UsageData()}
+        found, not_found = client.get_fonts_for_list(data)
+        self.assertEqual(1, len(found))
+        self.assertEqual({}, not_found)
+        self.assertEqual(set(data.keys()), set(client.resolved.keys()))
+
+    def test_collects_fonts_for_script(self):
+        client = FontClient(self.socket_path, self.font_dirs, False)
+        found, not_found = client.collect(get_file_in_test_directory('1.ass'), True, True)
+        self.assertEqual(17, len(found) + len(not_found))
+
+    def test_is_compatible_only_with_same_font_dirs(self):
+        self.assertTrue(FontClient(self.socket_path, self.font_dirs, False).is_compatible())
+        self.assertFalse(FontClient(self.socket_path, self.font_dirs, True).is_compatible())
+
+    def test_hung_server_is_not_compatible(self):
+        path = os.path.join(self.directory, 'hung.sock')
+        #accepts connections in the backlog but never answers
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as hung:
+            hung.bind(path)
+            hung.listen(1)
+            client = FontClient(path, self.font_dirs, False, ping_timeout=0.1)
+            self.assertFalse(client.is_compatible())
+            self.assertFalse(client.is_running())
+
+    def test_rejects_requests_for_different_font_dirs(self):
+        client = FontClient(self.socket_path, None, True)
+        with disabled_logging(logging.CRITICAL):
+            with self.assertRaises(FontServerError):
+                client.get_fonts_for_list({StyleInfo('Jorvik', 0, False) : UsageData()})
+
+    def test_refuses_to_start_second_server_on_same_socket(self):
+        with self.assertRaises(FontServerError):
+            FontServer(self.socket_path, None, self.font_dirs, False)
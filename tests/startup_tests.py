@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+import unittest
+
+
+def get_imported_modules(statement):
+    """Returns dict module -> cumulative import time in microseconds, as reported by python -X importtime"""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], stderr=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True).stderr
+    modules = {}
+    for line in output.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+class StartupTests(unittest.TestCase):
+    def test_cli_imports_no_heavy_modules(self):
+        modules = get_imported_modules('import assfc')
+        self.assertIn('assfc', modules)
+        for name in ['font_loader', 'ass_parser', 'font_server', 'sqlite3', 'pickle', 'hashlib', 'subprocess',
+                     'shutil', 'cProfile', 'concurrent.futures', 'glob', 'tempfile']:
+            self.assertNotIn(name, modules)
+
+    def test_font_loader_does_not_load_optional_modules(self):
+        modules = get_imported_modules('import font_loader')
+        self.assertIn('font_loader.font_cache', modules)
+        for name in ['font_loader.subsetter', 'font_loader.watcher', 'font_server', 'misc.matroska', 'misc.file_copy']:
+            self.assertNotIn(name, modules)
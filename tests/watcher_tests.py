@@ -0,0 +1,142 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from ass_parser import StyleInfo, UsageData
+from font_loader import FontLoader
+from font_loader.watcher import FontWatcher, InotifyWaiter
+from tests.common import get_file_in_test_directory
+
+
+class FontWatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.loader = FontLoader([self.directory], False)
+        self.watcher = FontWatcher(self.loader)
+        self.watcher.poll()
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.directory)
+
+    def find(self, name):
+        found, not_found = self.loader.get_fonts_for_list({StyleInfo(name, 0, False) : UsageData()})
+        return list(found.values())
+
+    def test_picks_up_added_fonts(self):
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), self.directory)
+        self.assertEqual(1, self.watcher.poll())
+        self.assertEqual(1, len(self.find('Jorvik Informal V2')))
+
+    def test_drops_removed_fonts(self):
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), self.directory)
+        self.watcher.poll()
+        os.remove(os.path.join(self.directory, 'Jorvik.ttf'))
+        self.assertEqual(1, self.watcher.poll())
+        self.assertFalse(self.find('Jorvik Informal V2'))
+
+    def test_rescans_replaced_fonts(self):
+        path = os.path.join(self.directory, 'font.ttf')
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), path)
+        self.watcher.poll()
+        shutil.copy(get_file_in_test_directory('seriously.ttf'), path)
+        self.assertEqual(1, self.watcher.poll())
+        self.assertFalse(self.find('Jorvik Informal V2'))
+        self.assertEqual(1, len(self.find('Seriously')))
+
+    def test_does_nothing_without_changes(self):
+        self.assertEqual(0, self.watcher.poll())
+
+    def test_rescans_only_given_directories(self):
+        os.mkdir(os.path.join(self.directory, 'other'))
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), self.directory)
+        self.assertEqual(0, self.watcher.poll({os.path.join(self.directory, 'other')}, set()))
+        self.assertEqual(1, self.watcher.poll({self.directory}, set()))
+        self.assertEqual(1, len(self.find('Jorvik Informal V2')))
+
+    def test_rescans_added_and_removed_directory_trees(self):
+        tree = os.path.join(self.directory, 'new')
+        os.makedirs(os.path.join(tree, 'nested'))
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), os.path.join(tree, 'nested'))
+        self.assertEqual(1, self.watcher.poll(set(), {tree}))
+        self.assertEqual(1, len(self.find('Jorvik Informal V2')))
+        shutil.rmtree(tree)
+        self.assertEqual(1, self.watcher.poll(set(), {tree}))
+        self.assertFalse(self.find('Jorvik Informal V2'))
+
+    def test_closes_replaced_index(self):
+        index = self.loader._FontLoader__index
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), self.directory)
+        self.watcher.poll()
+        self.assertIsNot(index, self.loader._FontLoader__index)
+        self.assertTrue(index._FontIndex__data.closed)
+
+    def wait_for(self, name, timeout = 5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.find(name):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_watches_directories_without_fonts(self):
+        os.makedirs(os.path.join(self.directory, 'empty', 'nested'))
+        self.watcher.poll()
+        directories = self.watcher._FontWatcher__directories
+        self.assertIn(os.path.join(self.directory, 'empty'), directories)
+        self.assertIn(os.path.join(self.directory, 'empty', 'nested'), directories)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_picks_up_fonts_added_to_directory_without_fonts(self):
+        nested = os.path.join(self.directory, 'empty', 'nested')
+        os.makedirs(nested)
+        self.watcher.poll()
+        self.watcher.interval = 0.1
+        self.watcher.full_poll_interval = 1000
+        self.watcher.start()
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), nested)
+        self.assertTrue(self.wait_for('Jorvik Informal V2'))
+
+    def test_polls_everything_when_no_change_is_reported(self):
+        class SilentWaiter(object):
+            def watch(self, directories):
+                pass
+            def wait(self, timeout):
+                time.sleep(timeout)
+                return None
+            def close(self):
+                pass
+        if self.watcher._FontWatcher__waiter is not None:
+            self.watcher._FontWatcher__waiter.close()
+        self.watcher._FontWatcher__waiter = SilentWaiter()
+        self.watcher.interval = 0.05
+        self.watcher.full_poll_interval = 0.1
+        self.watcher.start()
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), self.directory)
+        self.assertTrue(self.wait_for('Jorvik Informal V2'))
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+class InotifyWaiterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.waiter = InotifyWaiter()
+        self.waiter.settle_time = 0
+        self.waiter.watch([self.directory])
+
+    def tearDown(self):
+        self.waiter.close()
+        shutil.rmtree(self.directory)
+
+    def test_returns_nothing_without_changes(self):
+        self.assertIsNone(self.waiter.wait(0))
+
+    def test_reports_directory_of_changed_file(self):
+        shutil.copy(get_file_in_test_directory('Jorvik.ttf'), self.directory)
+        self.assertEqual(({self.directory}, set()), self.waiter.wait(1))
+
+    def test_reports_created_subdirectory_as_tree(self):
+        os.mkdir(os.path.join(self.directory, 'new'))
+        self.assertEqual((set(), {os.path.join(self.directory, 'new')}), self.waiter.wait(1))